@@ -4,16 +4,15 @@ import numpy as np
 import recordlinkage.compare 
 from bs4 import BeautifulSoup
 import os
+from scraping import open_manifest, report_counts
 
-# funcs
-def remove(x):
-    x.remove("")
-    return x   
+# crawl state (companies, links, downloads) written by scraping.py
+manifest = open_manifest("../data/scraping/crawl_manifest.sqlite", create=False)
 
 # responsibility reports 
 resp_reports_df = pd.read_csv("../data/scraping/responsibility_report_links.csv")
     
-resp_reports_df["num_of_reports"] = [len(remove(eval(obs))) if '' in eval(obs) else len(eval(obs)) for obs in resp_reports_df["Download links"]]
+resp_reports_df["num_of_reports"] = resp_reports_df["Company page"].map(report_counts(manifest, "resp_reports").set_index("company_page")["num_of_reports"])
 
 # this is an optional dummy to look at firms that have more than 5 reports
 # resp_reports_df = resp_reports_df[resp_reports_df["num_of_reports"] >=5]
@@ -59,7 +58,7 @@ merged["website"] = merged["characteristics_dirty"].apply(lambda html: html.find
 merged['website'] = np.where(merged["website"].isna(), pd.NA, merged["website"])
 merged["website"] = merged["website"].apply(lambda html: pd.NA if type(html)==pd._libs.missing.NAType else html['href'])
 
-merged["num_of_reports_ann"] = [len(remove(eval(obs))) if '' in eval(obs) else len(eval(obs)) for obs in merged["download_links_ann"]]
+merged["num_of_reports_ann"] = merged["company_page_ann"].map(report_counts(manifest, "annual_reports").set_index("company_page")["num_of_reports"])
 merged = merged[merged["num_of_reports_ann"] >=5]
 merged["sector"] = merged["sector"].str.replace("All ", "").str.replace(" Companies", "")
 
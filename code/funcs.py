@@ -2,17 +2,33 @@
 import pandas as pd
 import pymupdf
 import numpy as np
-from os import listdir, makedirs
-from os.path import exists
-from re import search, findall
-from traceback import print_exc
-from json import dump, load
+from os import listdir, makedirs, replace, remove, stat, utime
+from shutil import copyfile
+from hashlib import sha256
+from functools import partial
+from inspect import signature
+from time import perf_counter, time_ns
+import sqlite3
+import tracemalloc
+import pyarrow as pa
+import pyarrow.feather as feather
+from os.path import exists, isdir, join
+from re import search, findall, split
+from traceback import print_exc, format_exc
+from json import dump, load, dumps, loads
 from datasets import Dataset
 from transformers.pipelines.pt_utils import KeyDataset
+from transformers import AutoModelForSequenceClassification, AutoTokenizer, pipeline
+import torch
 from datasets import Dataset
 import statsmodels.api as sm
+from scipy import stats
 from itertools import product
 from datetime import datetime
+from pandas.api.types import is_datetime64_any_dtype
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from multiprocessing.shared_memory import SharedMemory
+from itertools import repeat
 
 def ExtractNameYear(series_names, input_dir, nlp_model, year_str):
     '''Extracts the first page of each document and checks the year of release.'''
@@ -91,83 +107,561 @@ def ExtractFileName(series_names, input_dir, year_str):
     return filename_year_dict    
 
 
-def ExtractAllText(filename_dict, year_str, output_path):
+def CleanCompanyName(row):
+    '''Turns a company name into the name of its report directory.'''
     
-    if not exists(output_path + "/" + year_str):
-        makedirs(output_path + "/" + year_str)
+    return row.lower().replace(" ", "_").replace("?", "").replace("|", "")
+
+
+def FirstPageNumbers(path, nlp_model):
+    '''Returns the first number of each sentence on the first page of a document.'''
+    
+    with pymupdf.open(path) as doc:
+        pages = doc[0].get_text()
+    
+    sentences = list(nlp_model(pages).sents)
+    
+    return [m.group() for sent in sentences if (m := search(r"\d+", sent.text))]
+
+
+def FastPageNumbers(path, n_pages=1):
+    '''Returns the first number of each sentence on the first n_pages of a document, using regex splitting instead of a spaCy parse.
+    
+    If the text holds no 4-digit number at all, the years of the PDF creation and modification dates are returned instead.'''
+    
+    with pymupdf.open(path) as doc:
+        pages = "\n".join(doc[page_num].get_text() for page_num in range(min(n_pages, len(doc))))
+        metadata = doc.metadata or {}
+    
+    # sentence ends and line breaks stand in for the spaCy sentence boundaries
+    sentences = split(r"(?<=[.!?])\s+|\n", pages)
+    num = [m.group() for sent in sentences if (m := search(r"\d+", sent))]
     
+    if not any(len(n) == 4 for n in num):
+        num = [m[0] for key in ("creationDate", "modDate") if (m := search(r"(?<=D:)\d{4}", metadata.get(key) or ""))]
     
+    return num
+
+
+def ExtractNameYearFast(series_names, input_dir, year_str, n_pages=1):
+    '''Same as ExtractNameYear, but detects the year of release with FastPageNumbers so that no spaCy model is needed.'''
     
-    for key in filename_dict.keys():
+    filename_year_dict = {}
+    for row in series_names:
+        company_name = CleanCompanyName(row)
+        company_dir = input_dir + "/" + company_name      
+        
+        for file in listdir(company_dir):    
+            path = company_dir + f"/{file}"
+            try:
+                if year_str in FastPageNumbers(path, n_pages):
+                    filename_year_dict[company_name] = (file, path)
+                    
+            except Exception as e:
+                with open("_exceptions.log", "a") as logfile:
+                    print_exc(file=logfile)
+                    logfile.write(rf"The company that the error occured on:{company_name}\n")
+                    logfile.write(f"The file that the error occured on:{path}")
         
-        if exists(output_path + "/" + year_str + "/" + key + ".json"):
+    return filename_year_dict
+
+
+def CompareYearDetection(series_names, input_dir, nlp_model, year_str, n_pages=1):
+    '''Runs ExtractNameYear and ExtractNameYearFast on the same companies and lists where they agree.'''
+    
+    spacy_dict = ExtractNameYear(series_names, input_dir, nlp_model, year_str)
+    fast_dict = ExtractNameYearFast(series_names, input_dir, year_str, n_pages)
+    
+    companies = [CleanCompanyName(row) for row in series_names]
+    df = pd.DataFrame({"NAME":companies, 
+                       "SPACY_PATH":[spacy_dict.get(company, (pd.NA, pd.NA))[1] for company in companies], 
+                       "FAST_PATH":[fast_dict.get(company, (pd.NA, pd.NA))[1] for company in companies]})
+    df["AGREE"] = (df["SPACY_PATH"] == df["FAST_PATH"]) | (df["SPACY_PATH"].isna() & df["FAST_PATH"].isna())
+    
+    return df
+
+
+def BuildReportIndex(input_dir, nlp_model=None, index_path=None):
+    '''Scans every company directory once and maps each company to its reports by year, from both the filenames and the first pages.
+    
+    Without an nlp_model the first pages are read with FastPageNumbers. If index_path points to an earlier index, 
+    only the files that are new or whose size or mtime changed are scanned again.'''
+    
+    old_files = {}
+    if index_path is not None and exists(index_path):
+        with open(index_path, "r") as file:
+            old_files = load(file)["files"]
+    
+    files = {}
+    for company_name in listdir(input_dir):
+        company_dir = input_dir + "/" + company_name
+        if not isdir(company_dir):
             continue
+        
+        for file in listdir(company_dir):
+            path = company_dir + f"/{file}"
+            file_stat = stat(path)
+            entry = old_files.get(path)
+            
+            if (entry is not None) and (entry["mtime"] == file_stat.st_mtime) and (entry["size"] == file_stat.st_size):
+                files[path] = entry
+                continue
+            
+            # same rule as ExtractFileName, only numbers preceded by an underscore count
+            filename_years = [num[1:] for num in findall(r"_\d+|\d+", file) if num.startswith("_")]
+            
+            try:
+                # only 4-digit numbers are kept from the first page, nothing else can match a year
+                page_nums = FirstPageNumbers(path, nlp_model) if nlp_model is not None else FastPageNumbers(path)
+                page_years = [num for num in page_nums if len(num) == 4]
+            except Exception as e:
+                page_years = []
+                with open("_exceptions_index.log", "a") as logfile:
+                    print_exc(file=logfile)
+                    logfile.write(rf"The company that the error occured on:{company_name}\n")
+                    logfile.write(f"The file that the error occured on:{path}")
+            
+            files[path] = {"company":company_name, "file":file, "mtime":file_stat.st_mtime, "size":file_stat.st_size, 
+                           "filename_years":filename_years, "page_years":page_years}
     
-        try:
-            with pymupdf.open(filename_dict[key][1]) as doc:
-                blocks = [page.get_text('blocks') for page in doc]
-                sents = []
+    # a year found in a filename always wins over a year found on a first page
+    companies = {}
+    for source in ("page_years", "filename_years"):
+        for path, entry in files.items():
+            for year in entry[source]:
+                companies.setdefault(entry["company"], {})[year] = path
+    
+    index = {"files":files, "companies":companies}
+    
+    if index_path is not None:
+        with open(index_path, "w") as file:
+            dump(index, file)
+    
+    return index
+
+
+def LookupReports(index, series_names, year_str):
+    '''Returns the same (filename, path) mapping as ExtractFileName followed by ExtractNameYear, served from a report index.'''
+    
+    filename_year_dict = {}
+    for row in series_names:
+        company_name = CleanCompanyName(row)
+        path = index["companies"].get(company_name, {}).get(year_str)
+        
+        if path is not None:
+            filename_year_dict[company_name] = (index["files"][path]["file"], path)
+    
+    return filename_year_dict
+
+
+def IsParagraph(text, min_words=20, min_newlines=3, min_alpha=0.7):
+    '''Checks whether a text block looks like a paragraph of running text.'''
+    
+    return (len(text.split(" ")) >= min_words) and (text.count("\n")>=min_newlines) and ('.' in text) and ((sum(ch.isalpha() for ch in text) / max(len(text), 1)) >= min_alpha)
+
+
+def ExtractReportText(key, path, year_str, output_path, par_filter=None):
+    '''Extracts the paragraphs of a single report and returns its error log (empty string if none).'''
+    
+    log = ""
+    try:
+        with pymupdf.open(path) as doc:
+            blocks = [page.get_text('blocks') for page in doc]
+            sents = []
+            
+            for page in blocks:
+                for par in page:
+                    if IsParagraph(par[4], **(par_filter or {})):
+                        sents.append(par[4]) 
+        
+        with open(output_path + "/" + year_str + "/" + key + ".json", "w") as file:
+            dump(sents, file)
                 
-                for page in blocks:
-                    for par in page:
-                        par_list = par[4].split(" ")
-                        if (len(par_list) >= 20) and (par[4].count("\n")>=3) and ('.' in par[4]) and ((sum(ch.isalpha() for ch in par[4]) / max(len(par[4]), 1)) >= 0.7):
-                            sents.append(par[4]) 
+    except Exception as e:
+        log = rf"The company that the error occured on:{key}\n" + format_exc()
+    
+    return log
+
+
+def StreamParagraphs(path, start_page=0, par_filter=None):
+    '''Yields the paragraphs of a report page by page, together with their page number and block coordinates.'''
+    
+    with pymupdf.open(path) as doc:
+        for page_num in range(start_page, len(doc)):
+            for par in doc[page_num].get_text('blocks'):
+                if IsParagraph(par[4], **(par_filter or {})):
+                    yield {"page":page_num, "x0":par[0], "y0":par[1], "x1":par[2], "y1":par[3], "text":par[4]}
+
+
+def StreamReportText(key, path, year_str, output_path, par_filter=None):
+    '''Writes the paragraphs of a single report to a JSONL file page by page and returns its error log (empty string if none).'''
+    
+    out_path = output_path + "/" + year_str + "/" + key + ".jsonl"
+    part_path = out_path + ".part"
+    
+    log = ""
+    try:
+        # a leftover .part file means an earlier run died, so the last written page is redone and everything before it kept
+        start_page = 0
+        if exists(part_path):
+            rows = []
+            with open(part_path, "r") as file:
+                for line in file:
+                    try:
+                        rows.append(loads(line))
+                    except ValueError:
+                        break
             
-            with open(output_path + "/" + year_str + "/" + key + ".json", "w") as file:
-                dump(sents, file)
-                    
-        except Exception as e:
-            with open(output_path + "/" + year_str + "/" + "_exceptions_all_text.log", "a") as logfile:
-                logfile.write(rf"The company that the error occured on:{key}\n")
-                print_exc(file=logfile)
+            start_page = max([row["page"] for row in rows], default=0)
+            with open(part_path, "w") as file:
+                file.writelines(dumps(row) + "\n" for row in rows if row["page"] < start_page)
+        
+        with open(part_path, "a") as file:
+            page_num = start_page
+            for row in StreamParagraphs(path, start_page, par_filter):
+                if row["page"] != page_num:
+                    file.flush()
+                    page_num = row["page"]
+                file.write(dumps(row) + "\n")
+        
+        replace(part_path, out_path)
+    
+    except Exception as e:
+        log = rf"The company that the error occured on:{key}\n" + format_exc()
+    
+    return log
+
+
+def ReadParagraphs(path):
+    '''Lazily yields the paragraph texts of an extracted report, either from a JSONL file or from a JSON list.'''
+    
+    if path.endswith(".jsonl"):
+        with open(path, "r") as file:
+            for line in file:
+                yield loads(line)["text"]
+    else:
+        with open(path, "r") as file:
+            yield from load(file)
+
+
+def ReportCacheKey(path, par_filter=None, extension=".json"):
+    '''Hashes the content of a report together with the paragraph filter settings and the output format.'''
+    
+    digest = sha256()
+    with open(path, "rb") as file:
+        for chunk in iter(lambda: file.read(1 << 20), b""):
+            digest.update(chunk)
+    
+    # the defaults of IsParagraph are filled in so that passing them explicitly hits the same entry
+    settings = {name: param.default for name, param in signature(IsParagraph).parameters.items() if name != "text"}
+    settings.update(par_filter or {})
+    digest.update(dumps([sorted(settings.items()), extension]).encode())
+    
+    return digest.hexdigest()
+
+
+def CachedReportText(key, path, year_str, output_path, extract_func, extension, cache_dir, par_filter=None):
+    '''Serves the paragraphs of a report from the extraction cache and only parses the PDF on a miss.'''
+    
+    out_path = output_path + "/" + year_str + "/" + key + extension
+    
+    try:
+        cache_path = cache_dir + "/" + ReportCacheKey(path, par_filter, extension) + extension
+        
+        if exists(cache_path):
+            copyfile(cache_path, out_path)
+            # bumping the mtime so that the eviction drops the least recently used entries first
+            utime(cache_path)
+            return ""
+    
+    except Exception as e:
+        return rf"The company that the error occured on:{key}\n" + format_exc()
+    
+    log = extract_func(key, path, year_str, output_path, par_filter)
+    
+    if not log:
+        # copying under a temporary name first so that a parallel worker never reads a half-written entry
+        copyfile(out_path, cache_path + "." + key + ".tmp")
+        replace(cache_path + "." + key + ".tmp", cache_path)
+    
+    return log
+
+
+def PruneCache(cache_dir, max_bytes):
+    '''Deletes the least recently used cache entries until the cache fits into max_bytes.'''
+    
+    entries = [cache_dir + "/" + file for file in listdir(cache_dir) if not file.endswith(".tmp")]
+    entries = sorted((stat(entry).st_mtime, stat(entry).st_size, entry) for entry in entries)
+    
+    total = sum(size for _, size, _ in entries)
+    for _, size, entry in entries:
+        if total <= max_bytes:
+            break
+        remove(entry)
+        total -= size
+
+
+def ExtractAllText(filename_dict, year_str, output_path, n_workers=1, stream=False, cache_dir=None, cache_max_bytes=5*1024**3, par_filter=None):
+    '''Dumps the paragraphs of each report to a JSON file (JSONL written page by page if stream=True), spreading the reports over n_workers processes if n_workers > 1.
+    
+    Without a cache_dir, reports whose output file already exists are skipped. With a cache_dir, every report is looked up by its content hash 
+    and the filter settings instead, so changed reports are re-extracted and unchanged ones are never parsed twice.'''
+    
+    if not exists(output_path + "/" + year_str):
+        makedirs(output_path + "/" + year_str)
+    
+    if stream:
+        extract_func, extension = StreamReportText, ".jsonl"
+    else:
+        extract_func, extension = ExtractReportText, ".json"
+    
+    if cache_dir is None:
+        keys = [key for key in filename_dict.keys() if not exists(output_path + "/" + year_str + "/" + key + extension)]
+        extract = partial(extract_func, par_filter=par_filter)
+    else:
+        if not exists(cache_dir):
+            makedirs(cache_dir)
+        keys = list(filename_dict.keys())
+        extract = partial(CachedReportText, extract_func=extract_func, extension=extension, cache_dir=cache_dir, par_filter=par_filter)
+    
+    paths = [filename_dict[key][1] for key in keys]
+    
+    # each worker returns the log of its own report, the logs are merged once everything is done
+    if n_workers > 1:
+        with ProcessPoolExecutor(max_workers=n_workers) as executor:
+            logs = list(executor.map(extract, keys, paths, repeat(year_str), repeat(output_path)))
+    else:
+        logs = [extract(key, path, year_str, output_path) for key, path in zip(keys, paths)]
+    
+    if cache_dir is not None:
+        PruneCache(cache_dir, cache_max_bytes)
+    
+    logs = [log for log in logs if log]
+    if logs:
+        with open(output_path + "/" + year_str + "/" + "_exceptions_all_text.log", "a") as logfile:
+            logfile.write("".join(logs))
    
-def Classify(sentences, pipe):
+def LengthBuckets(lengths, token_budget):
+    '''Groups paragraph indices sorted by length into batches whose padded size (longest paragraph x batch size) stays within token_budget.'''
+    
+    buckets = []
+    bucket = []
+    for idx in sorted(range(len(lengths)), key=lambda i: lengths[i]):
+        # sorted ascending, so the paragraph being added is always the longest one in the bucket
+        if bucket and (len(bucket)+1)*lengths[idx] > token_budget:
+            buckets.append(bucket)
+            bucket = []
+        bucket.append(idx)
+    
+    if bucket:
+        buckets.append(bucket)
+    
+    return buckets
+
+
+def Classify(sentences, pipe, batch_size=None, token_budget=None, cache_path=None):
+    '''Classifies the paragraphs with the pipeline, either as one dataset with a fixed batch_size or, if token_budget is set, 
+    in length-sorted buckets of at most token_budget padded tokens, with the outputs put back in the original order.
+    
+    If cache_path is set, the labels are served from the SQLite cache there and only the missing paragraphs are classified.'''
+    
+    if cache_path is not None:
+        return ClassifyCached(sentences, pipe, cache_path, batch_size, token_budget)
+    
     classifiers = []
     scores = []
     
-    dataset = Dataset.from_pandas(pd.DataFrame({"sentences":sentences}))
+    if token_budget is None:
+        dataset = Dataset.from_pandas(pd.DataFrame({"sentences":sentences}))
+        
+        for out in pipe(KeyDataset(dataset, 'sentences'), padding=True, truncation=True, batch_size=batch_size):
+            classifiers.append(out["label"])
+            scores.append(out["score"])
     
-    for out in pipe(KeyDataset(dataset, 'sentences'), padding=True, truncation=True):
-        classifiers.append(out["label"])
-        scores.append(out["score"])
+    else:
+        lengths = [len(ids) for ids in pipe.tokenizer(list(sentences), truncation=True)["input_ids"]] if len(sentences) else []
+        
+        classifiers = [None]*len(sentences)
+        scores = [None]*len(sentences)
+        for bucket in LengthBuckets(lengths, token_budget):
+            outs = pipe([sentences[idx] for idx in bucket], padding=True, truncation=True, batch_size=len(bucket))
+            
+            for idx, out in zip(bucket, outs):
+                classifiers[idx] = out["label"]
+                scores[idx] = out["score"]
         
     df = pd.DataFrame({'texts':sentences,
                      'classifier':classifiers, 
                      "score":scores})
     
     return df
+
+
+def ParagraphHash(text):
+    '''Hashes a paragraph after collapsing its whitespace, so that the same text with different line breaks gets the same key.'''
+    
+    return sha256(" ".join(text.split()).encode()).hexdigest()
+
+
+def ClassifyCached(sentences, pipe, cache_path, batch_size=None, token_budget=None):
+    '''Looks up the paragraphs in a persistent (model name, paragraph hash) -> (label, score) cache and classifies only the misses, 
+    each distinct paragraph once.'''
+    
+    # pipelines from MakeCPUPipeline carry their backend in the name so that they never share entries with the fp32 model
+    model_name = pipe.cache_name if hasattr(pipe, "cache_name") else pipe.model.name_or_path
+    hashes = [ParagraphHash(text) for text in sentences]
+    unique_hashes = list(dict.fromkeys(hashes))
+    
+    con = sqlite3.connect(cache_path)
+    try:
+        con.execute("CREATE TABLE IF NOT EXISTS classifications (model TEXT, hash TEXT, label TEXT, score REAL, PRIMARY KEY (model, hash))")
+        
+        # looking the hashes up in chunks, SQLite limits the number of parameters per query
+        cached = {}
+        for i in range(0, len(unique_hashes), 900):
+            chunk = unique_hashes[i:i+900]
+            query = f"SELECT hash, label, score FROM classifications WHERE model = ? AND hash IN ({','.join('?'*len(chunk))})"
+            cached.update({row[0]:(row[1], row[2]) for row in con.execute(query, [model_name, *chunk])})
+        
+        # duplicates within the batch are classified only once, using the first text they appear with
+        misses = {}
+        for paragraph_hash, text in zip(hashes, sentences):
+            if paragraph_hash not in cached:
+                misses.setdefault(paragraph_hash, text)
+        
+        if misses:
+            miss_df = Classify(list(misses.values()), pipe, batch_size, token_budget)
+            new_rows = list(zip(repeat(model_name), misses.keys(), miss_df["classifier"], miss_df["score"].astype(float)))
+            
+            with con:
+                con.executemany("INSERT OR REPLACE INTO classifications VALUES (?, ?, ?, ?)", new_rows)
+            cached.update({row[1]:(row[2], row[3]) for row in new_rows})
+    
+    finally:
+        con.close()
+    
+    df = pd.DataFrame({'texts':sentences,
+                     'classifier':[cached[paragraph_hash][0] for paragraph_hash in hashes], 
+                     "score":[cached[paragraph_hash][1] for paragraph_hash in hashes]})
+    
+    return df
+
+
+def BenchmarkClassify(sentences, pipe, batch_sizes=(1, 8, 16, 32, 64), token_budgets=(2048, 4096, 8192, 16384)):
+    '''Times Classify on the same paragraphs for each fixed batch size and each token budget and reports the paragraphs per second.'''
+    
+    settings = [{"batch_size":batch_size, "token_budget":None} for batch_size in batch_sizes]
+    settings += [{"batch_size":None, "token_budget":token_budget} for token_budget in token_budgets]
+    
+    rows = []
+    for setting in settings:
+        start = perf_counter()
+        Classify(sentences, pipe, **setting)
+        seconds = perf_counter() - start
+        
+        rows.append({"BATCH_SIZE":setting["batch_size"], 
+                     "TOKEN_BUDGET":setting["token_budget"], 
+                     "SECONDS":seconds, 
+                     "PARAGRAPHS_PER_SEC":len(sentences)/seconds})
+    
+    return pd.DataFrame(rows)
         
 
-def ComputeGreenInd(series_name, input_dir, pipe_class, pipe_spec): 
+def MakeCPUPipeline(model_name, backend="int8", export_dir=None, max_len=512):
+    '''Builds a CPU text-classification pipeline for a ClimateBERT model, either with dynamic int8 quantization of the linear layers ("int8"), 
+    as an ONNX export ("onnx") or as an ONNX export with dynamic int8 quantization ("onnx-int8"). The ONNX backends need optimum[onnxruntime].'''
+    
+    tokenizer = AutoTokenizer.from_pretrained(model_name, max_len=max_len)
+    
+    if backend == "int8":
+        model = AutoModelForSequenceClassification.from_pretrained(model_name)
+        model = torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+    
+    elif backend in ("onnx", "onnx-int8"):
+        from optimum.onnxruntime import ORTModelForSequenceClassification, ORTQuantizer
+        from optimum.onnxruntime.configuration import AutoQuantizationConfig
+        
+        if export_dir is None:
+            export_dir = model_name.replace("/", "_") + "_onnx"
+        
+        # an earlier export in export_dir is reused instead of exporting the model again
+        if exists(join(export_dir, "model.onnx")):
+            model = ORTModelForSequenceClassification.from_pretrained(export_dir, file_name="model.onnx")
+        else:
+            model = ORTModelForSequenceClassification.from_pretrained(model_name, export=True)
+            model.save_pretrained(export_dir)
+
+        if backend == "onnx-int8":
+            if not exists(join(export_dir, "model_quantized.onnx")):
+                quantizer = ORTQuantizer.from_pretrained(model)
+                quantizer.quantize(save_dir=export_dir, quantization_config=AutoQuantizationConfig.avx2(is_static=False, per_channel=False))
+            model = ORTModelForSequenceClassification.from_pretrained(export_dir, file_name="model_quantized.onnx")
+    
+    else:
+        raise ValueError(f"Unknown backend: {backend}")
+    
+    pipe = pipeline("text-classification", model=model, tokenizer=tokenizer, device=-1)
+    pipe.cache_name = model_name + ":" + backend
+    
+    return pipe
+
+
+def CompareBackends(sentences, pipe_ref, pipe_test, batch_size=32):
+    '''Classifies the same held-out paragraphs with the reference (fp32) pipeline and a CPU backend and reports 
+    the label agreement, the score differences and the latency and throughput of both.'''
+    
+    results = {}
+    for name, pipe in (("REF", pipe_ref), ("TEST", pipe_test)):
+        start = perf_counter()
+        results[name] = Classify(sentences, pipe, batch_size)
+        seconds = perf_counter() - start
+        
+        results[name + "_SECONDS"] = seconds
+    
+    score_diff = (results["REF"]["score"] - results["TEST"]["score"]).abs()
+    
+    report = pd.DataFrame({"N":[len(sentences)], 
+                           "LABEL_AGREEMENT":[(results["REF"]["classifier"] == results["TEST"]["classifier"]).mean()], 
+                           "MEAN_ABS_SCORE_DIFF":[score_diff.mean()], 
+                           "MAX_ABS_SCORE_DIFF":[score_diff.max()], 
+                           "REF_MS_PER_PARAGRAPH":[1000*results["REF_SECONDS"]/max(len(sentences), 1)], 
+                           "TEST_MS_PER_PARAGRAPH":[1000*results["TEST_SECONDS"]/max(len(sentences), 1)], 
+                           "REF_PARAGRAPHS_PER_SEC":[len(sentences)/results["REF_SECONDS"]], 
+                           "TEST_PARAGRAPHS_PER_SEC":[len(sentences)/results["TEST_SECONDS"]]})
+    
+    return report
+
+
+def CompanyGreenInd(path, pipe_class, pipe_spec, cache_path=None):
+    '''Computes the number of climate-related and non-specific paragraphs and the greenwashing indicator for one extracted report.'''
+    
+    txt_list = list(ReadParagraphs(path))
+    
+    class_df = Classify(txt_list, pipe_class, cache_path=cache_path)
+    
+    class_df = class_df.loc[class_df["classifier"]=="yes"]
+    
+    spec_df = Classify(class_df["texts"].to_list(), pipe_spec, cache_path=cache_path)
+    
+    non_spec_df = spec_df.loc[spec_df["classifier"]=="non"]
+    
+    num_clim_related = len(class_df)
+    num_non_spec = len(non_spec_df)
+    green_ind = (num_non_spec+1)/(num_clim_related+1) 
+    
+    return num_clim_related, num_non_spec, green_ind
+
+
+def ComputeGreenInd(series_name, input_dir, pipe_class, pipe_spec, stream=False, cache_path=None): 
     
     clim_related_nums = []
     non_spec_nums = []
     green_inds = []
     for row in series_name:
         try:
-            company_name = row.lower().replace(" ", "_")
-            
-            if any(i in company_name for i in ("?", "|")):
-                company_name = company_name.replace("?", "")
-                company_name = company_name.replace("|", "")
-            
-            company_dir = input_dir + "/" + company_name + '.json'
-            
-            with open(company_dir, 'r') as file:
-                txt_list = load(file)
-            
-            class_df = Classify(txt_list, pipe_class)
-            
-            class_df = class_df.loc[class_df["classifier"]=="yes"]
-            
-            spec_df = Classify(class_df["texts"].to_list(), pipe_spec)
-            
-            non_spec_df = spec_df.loc[spec_df["classifier"]=="non"]
+            company_dir = input_dir + "/" + CleanCompanyName(row) + ('.jsonl' if stream else '.json')
             
-            num_clim_related = len(class_df)
-            num_non_spec = len(non_spec_df)
-            green_ind = (num_non_spec+1)/(num_clim_related+1) 
+            num_clim_related, num_non_spec, green_ind = CompanyGreenInd(company_dir, pipe_class, pipe_spec, cache_path)
             
             clim_related_nums.append(num_clim_related)  
             non_spec_nums.append(num_non_spec)
@@ -192,7 +686,297 @@ def ComputeGreenInd(series_name, input_dir, pipe_class, pipe_spec):
     return df
 
 
-def TransformReturns(df, df_characteristic, old=False):
+def ComputeGreenIndCorpus(series_name, input_dir, pipe_class, pipe_spec, stream=False, batch_size=64, token_budget=None, cache_path=None):
+    '''Same as ComputeGreenInd, but classifies the paragraphs of all companies in one run with large batches.'''
+    
+    # loading the paragraphs of every company into one corpus, remembering which company each paragraph belongs to
+    texts = []
+    owners = []
+    failed = set()
+    for row in dict.fromkeys(series_name):
+        try:
+            company_dir = input_dir + "/" + CleanCompanyName(row) + ('.jsonl' if stream else '.json')
+            txt_list = list(ReadParagraphs(company_dir))
+            
+            texts.extend(txt_list)
+            owners.extend([row]*len(txt_list))
+        
+        except Exception as e:
+            failed.add(row)
+            with open(f"{input_dir}/_exceptions_green_ind.log", "a") as logfile:
+                logfile.write(rf"The company that the error occured on:{row}\n")
+                print_exc(file=logfile)
+    
+    class_df = Classify(texts, pipe_class, batch_size, token_budget, cache_path)
+    class_df["NAME"] = owners
+    
+    class_df = class_df.loc[class_df["classifier"]=="yes"]
+    
+    # the specificity model only sees the climate-related paragraphs
+    spec_df = Classify(class_df["texts"].to_list(), pipe_spec, batch_size, token_budget, cache_path)
+    spec_df["NAME"] = class_df["NAME"].to_list()
+    
+    non_spec_df = spec_df.loc[spec_df["classifier"]=="non"]
+    
+    clim_related_counts = class_df["NAME"].value_counts()
+    non_spec_counts = non_spec_df["NAME"].value_counts()
+    
+    clim_related_nums = []
+    non_spec_nums = []
+    green_inds = []
+    for row in series_name:
+        if row in failed:
+            clim_related_nums.append(pd.NA)  
+            non_spec_nums.append(pd.NA)
+            green_inds.append(pd.NA)
+            continue
+        
+        num_clim_related = int(clim_related_counts.get(row, 0))
+        num_non_spec = int(non_spec_counts.get(row, 0))
+        
+        clim_related_nums.append(num_clim_related)  
+        non_spec_nums.append(num_non_spec)
+        green_inds.append((num_non_spec+1)/(num_clim_related+1))
+    
+    df = pd.DataFrame({"NAME":series_name, 
+                    'CLIMATE_REL':clim_related_nums, 
+                    "NON_SPEC":non_spec_nums,
+                    "GREEN_IND":green_inds
+                    })
+    
+    return df
+
+
+def ReadGreenIndPanel(store_dir):
+    '''Reads the (company, year) green-index panel from its parquet parts, keeping only the latest record of each company-year.'''
+    
+    parts = sorted(file for file in listdir(store_dir) if file.endswith(".parquet")) if exists(store_dir) else []
+    if not parts:
+        return pd.DataFrame(columns=["NAME", "YEAR", "CLIMATE_REL", "NON_SPEC", "GREEN_IND", "STATUS", "ERROR", "COMPUTED_AT"])
+    
+    df = pd.concat([pd.read_parquet(store_dir + "/" + part) for part in parts], ignore_index=True)
+    df = df.sort_values("COMPUTED_AT").drop_duplicates(subset=["NAME", "YEAR"], keep="last").reset_index(drop=True)
+    
+    return df
+
+
+def BuildGreenIndPanel(names_by_year, input_dir, pipe_class, pipe_spec, store_dir, checkpoint_every=50, stream=False, cache_path=None):
+    '''Computes the greenwashing indicator for every (company, year) in names_by_year ({year_str: series of names}), reading the reports 
+    from input_dir/<year>, and appends the results to a parquet store every checkpoint_every companies.
+    
+    Company-years already computed successfully are skipped, so a restarted run or a run with new years or companies only processes 
+    what is missing. Failures are stored with STATUS "failed" and the traceback and are retried on the next run.'''
+    
+    if not exists(store_dir):
+        makedirs(store_dir)
+    
+    done = ReadGreenIndPanel(store_dir)
+    done = set(zip(done.loc[done["STATUS"]=="ok", "NAME"], done.loc[done["STATUS"]=="ok", "YEAR"]))
+    
+    def checkpoint(records):
+        # every checkpoint is a new part file, earlier parts are never rewritten
+        df = pd.DataFrame(records)
+        df = df.astype({"CLIMATE_REL":"Int64", "NON_SPEC":"Int64", "GREEN_IND":"float64"})
+        df.to_parquet(store_dir + f"/part_{time_ns()}.parquet", index=False)
+    
+    records = []
+    for year_str, series_name in names_by_year.items():
+        for row in dict.fromkeys(series_name):
+            if (row, year_str) in done:
+                continue
+            
+            record = {"NAME":row, "YEAR":year_str, "CLIMATE_REL":pd.NA, "NON_SPEC":pd.NA, "GREEN_IND":np.nan, "STATUS":"ok", "ERROR":""}
+            try:
+                company_dir = input_dir + "/" + year_str + "/" + CleanCompanyName(row) + ('.jsonl' if stream else '.json')
+                record["CLIMATE_REL"], record["NON_SPEC"], record["GREEN_IND"] = CompanyGreenInd(company_dir, pipe_class, pipe_spec, cache_path)
+            
+            except Exception as e:
+                record["STATUS"] = "failed"
+                record["ERROR"] = format_exc()
+            
+            record["COMPUTED_AT"] = time_ns()
+            records.append(record)
+            
+            if len(records) >= checkpoint_every:
+                checkpoint(records)
+                records = []
+    
+    if records:
+        checkpoint(records)
+    
+    return ReadGreenIndPanel(store_dir)
+
+
+def HeaderToJson(col):
+    '''A column name as [kind, value] for the Arrow metadata, so ReadArrow can give back dates, numbers and strings as they were.'''
+    
+    if isinstance(col, datetime):
+        return ["timestamp", pd.Timestamp(col).isoformat()]
+    if isinstance(col, (np.integer, np.floating, np.bool_)):
+        col = col.item()
+    if isinstance(col, (bool, int, float, str)) or col is None:
+        return ["value", col]
+    return ["value", str(col)]
+
+
+def WriteArrow(df, path):
+    '''Writes a frame to an uncompressed Arrow (Feather) file, remembering the original column names (dates, numbers or strings). 
+    Object columns that mix strings with numbers (e.g. "NA" or "$$ER" cells in a Datastream sheet) are stored as a string part 
+    and a numeric part and put back together by ReadArrow.'''
+    
+    # Arrow only takes unique string column names, the wide Datastream sheets use dates as column names
+    headers = [HeaderToJson(col) for col in df.columns]
+    out = {}
+    mixed = []
+    for i, (_, values) in enumerate(df.items()):
+        out[str(i)] = values
+        if values.dtype != object:
+            continue
+        try:
+            pa.array(values, from_pandas=True)
+        except (pa.ArrowInvalid, pa.ArrowTypeError):
+            is_str = values.map(lambda value: isinstance(value, str)).to_numpy(dtype=bool)
+            out[str(i)] = pd.Series(np.where(is_str, None, values), index=values.index, dtype=object)
+            out[f"{i}_str"] = pd.Series(np.where(is_str, values, None), index=values.index, dtype=object)
+            mixed.append(i)
+    
+    table = pa.Table.from_pandas(pd.DataFrame(out, index=df.index))
+    table = table.replace_schema_metadata({**(table.schema.metadata or {}), 
+                                           b"columns":dumps(headers).encode(), b"mixed_columns":dumps(mixed).encode()})
+    
+    feather.write_feather(table, path + ".tmp", compression="uncompressed")
+    replace(path + ".tmp", path)
+
+
+def ReadArrow(path):
+    '''Memory-maps a file written by WriteArrow and turns it back into a frame with the original column names.'''
+    
+    table = feather.read_table(path, memory_map=True)
+    headers = loads(table.schema.metadata[b"columns"])
+    mixed = loads(table.schema.metadata.get(b"mixed_columns", b"[]"))
+    
+    df = table.to_pandas()
+    for i in mixed:
+        values = df[str(i)].astype(object)
+        strings = df.pop(f"{i}_str")
+        df[str(i)] = values.where(strings.isna(), strings)
+    
+    df = df[[str(i) for i in range(len(headers))]]
+    df.columns = [pd.Timestamp(value) if kind == "timestamp" else value for kind, value in headers]
+    
+    return df
+
+
+def CheckWorkbookCache(workbook_path, cache_dir):
+    '''Empties cache_dir if the workbook changed since the cache was built. The mtime and size are checked first and the content hash 
+    only when they differ, so a touched but unchanged workbook keeps its cache.'''
+    
+    if not exists(cache_dir):
+        makedirs(cache_dir)
+    
+    manifest_path = cache_dir + "/_manifest.json"
+    manifest = {}
+    if exists(manifest_path):
+        with open(manifest_path, "r") as file:
+            manifest = load(file)
+    
+    file_stat = stat(workbook_path)
+    if (manifest.get("mtime") == file_stat.st_mtime) and (manifest.get("size") == file_stat.st_size):
+        return
+    
+    digest = sha256()
+    with open(workbook_path, "rb") as file:
+        for chunk in iter(lambda: file.read(1 << 20), b""):
+            digest.update(chunk)
+    
+    if manifest.get("sha256") != digest.hexdigest():
+        for file in listdir(cache_dir):
+            if file.endswith(".arrow"):
+                remove(cache_dir + "/" + file)
+    
+    with open(manifest_path, "w") as file:
+        dump({"workbook":workbook_path, "mtime":file_stat.st_mtime, "size":file_stat.st_size, "sha256":digest.hexdigest()}, file)
+
+
+def ReadSheetCached(workbook_path, sheet_name, cache_dir, **read_kwargs):
+    '''Reads a sheet of the Datastream workbook, parsing the Excel file only the first time and memory-mapping the Arrow copy afterwards.'''
+    
+    CheckWorkbookCache(workbook_path, cache_dir)
+    
+    # the read options are part of the name, so the same sheet read with a different skiprows gets its own file
+    options = sha256(dumps(sorted(read_kwargs.items()), default=str).encode()).hexdigest()[:8]
+    cache_path = cache_dir + "/" + sheet_name.replace("/", "_") + "_" + options + ".arrow"
+    
+    if exists(cache_path):
+        return ReadArrow(cache_path)
+    
+    df = pd.read_excel(workbook_path, sheet_name=sheet_name, **read_kwargs)
+    try:
+        WriteArrow(df, cache_path)
+    except Exception as e:
+        # not cached, the parsed sheet is still good
+        print(f"Could not cache {sheet_name}: {e}")
+    
+    return df
+
+
+def CachedFrame(workbook_path, cache_dir, name, build_func, *args, **kwargs):
+    '''Returns build_func(*args, **kwargs) from the workbook cache, e.g. the long panel of TransformReturns, building and storing it only 
+    if it is missing. The entry is dropped together with the sheets when the workbook changes.'''
+    
+    CheckWorkbookCache(workbook_path, cache_dir)
+    
+    cache_path = cache_dir + "/" + name + ".arrow"
+    if exists(cache_path):
+        return ReadArrow(cache_path)
+    
+    df = build_func(*args, **kwargs)
+    try:
+        WriteArrow(df, cache_path)
+    except Exception as e:
+        print(f"Could not cache {name}: {e}")
+    
+    return df
+
+
+def MakePanel(df):
+    '''Turns a long NAME/DATE frame into a panel with datetime64 dates and categorical names, sorted by (NAME, DATE).'''
+    
+    df = df.copy()
+    df["DATE"] = pd.to_datetime(df["DATE"])
+    df["NAME"] = df["NAME"].astype("category")
+    
+    # categories are sorted, so sorting by NAME sorts by the category codes
+    df = df.sort_values(["NAME", "DATE"], ignore_index=True)
+    
+    return df
+
+
+def PanelSlice(panel, name=None, start=None, end=None):
+    '''Returns the rows of a MakePanel panel for one firm and/or a date range (both ends inclusive). The firm block and the dates within it 
+    are found by binary search on the sorted codes and dates, without a boolean mask over the whole panel.'''
+    
+    if name is None:
+        mask = np.ones(len(panel), dtype=bool)
+        if start is not None:
+            mask &= (panel["DATE"] >= pd.Timestamp(start)).to_numpy()
+        if end is not None:
+            mask &= (panel["DATE"] <= pd.Timestamp(end)).to_numpy()
+        return panel[mask]
+    
+    codes = panel["NAME"].cat.codes.to_numpy()
+    code = panel["NAME"].cat.categories.get_loc(name)
+    lo, hi = np.searchsorted(codes, code, side="left"), np.searchsorted(codes, code, side="right")
+    
+    # dates are sorted within the firm block
+    dates = panel["DATE"].to_numpy()[lo:hi]
+    first = np.searchsorted(dates, pd.Timestamp(start).to_datetime64(), side="left") if start is not None else 0
+    last = np.searchsorted(dates, pd.Timestamp(end).to_datetime64(), side="right") if end is not None else len(dates)
+    
+    return panel.iloc[lo+first:lo+last]
+
+
+def TransformReturns(df, df_characteristic, old=False, panel=False):
     if old==True:
         df = df[(df['Retrieving...'].str.contains("PRICE INDEX")) | (df['Retrieving...'].str.contains("TOT RETURN IND"))]
         df.loc[:,"NAME"] = df.loc[:,"Retrieving..."].str.removesuffix(' - PRICE INDEX').str.removesuffix(" - TOT RETURN IND")
@@ -204,7 +988,7 @@ def TransformReturns(df, df_characteristic, old=False):
         df = pd.melt(df, id_vars=['NAME', "VARIABLE"]).pivot_table(index=['NAME', 'variable'], columns='VARIABLE', values='value').reset_index().rename(columns={'variable':'DATE'})
         df = df.merge(df_characteristic[['NAME', 'CTRY_OF_DOM_NAME', 'BOURSE_NAME']], how="left", on="NAME")
 
-        df["DATE"] = df["DATE"].dt.date
+        df["DATE"] = df["DATE"] if panel else df["DATE"].dt.date
     
     else:   
         df = df[df['Name'].str.contains("PRICE INDEX")]
@@ -216,11 +1000,14 @@ def TransformReturns(df, df_characteristic, old=False):
         df = pd.melt(df, id_vars=['NAME', "VARIABLE"]).pivot_table(index=['NAME', 'variable'], columns='VARIABLE', values='value').reset_index().rename(columns={'variable':'DATE'})
         df = df.merge(df_characteristic[['NAME', 'CTRY_OF_DOM_NAME', 'BOURSE_NAME']], how="left", on="NAME")
 
-        df["DATE"] = df["DATE"].dt.date
+        df["DATE"] = df["DATE"] if panel else df["DATE"].dt.date
+
+    if panel:
+        df = MakePanel(df)
 
     return df    
 
-def TransformIndices(df, weekly=False):
+def TransformIndices(df, weekly=False, panel=False):
     if weekly==True:
         pass
         df.loc[:,"NAME"] = df.loc[:,"Name"].str.removesuffix(' - PRICE INDEX')
@@ -229,7 +1016,7 @@ def TransformIndices(df, weekly=False):
 
         df = pd.melt(df, id_vars=['NAME', "VARIABLE"]).pivot_table(index=['NAME', 'variable'], columns='VARIABLE', values='value').reset_index().rename(columns={'variable':'DATE'})
 
-        df["DATE"] = df["DATE"].dt.date
+        df["DATE"] = df["DATE"] if panel else df["DATE"].dt.date
 
     else:
         df.loc[:,"NAME"] = df.loc[:,"Name"].str.removesuffix(' - PRICE INDEX')
@@ -238,12 +1025,123 @@ def TransformIndices(df, weekly=False):
 
         df = pd.melt(df, id_vars=['NAME', "VARIABLE"]).pivot_table(index=['NAME', 'variable'], columns='VARIABLE', values='value').reset_index().rename(columns={'variable':'DATE'})
 
-        df["DATE"] = df["DATE"].dt.date
-
+        df["DATE"] = df["DATE"] if panel else df["DATE"].dt.date
 
+    if panel:
+        df = MakePanel(df)
 
     return df
 
+
+
+def WideToLong(df, label_col, variables, drop_cols=()):
+    '''Reshapes a wide Datastream export (one row per firm and variable, one column per date) straight from its numeric block into 
+    a long frame with categorical NAME, datetime64 DATE and one column per variable, sorted by (NAME, DATE). 
+    
+    Rows are matched to a variable by the " - <variable>" suffix of label_col. Unlike melt + pivot_table nothing is aggregated, 
+    a (NAME, DATE) that is missing for every variable is dropped as pivot_table does.'''
+    
+    labels = df[label_col].astype(str)
+    date_cols = [col for col in df.columns if col not in (label_col, *drop_cols)]
+    
+    dates = pd.to_datetime(pd.Index(date_cols))
+    order = dates.argsort()
+    dates = dates[order]
+    date_cols = [date_cols[i] for i in order]
+    
+    rows_by_var = {}
+    for var in variables:
+        rows = labels.str.contains(" - " + var, regex=False).to_numpy()
+        rows_by_var[var] = (labels[rows].str.removesuffix(" - " + var).to_numpy(), rows)
+    
+    names = pd.Index(np.unique(np.concatenate([var_names for var_names, _ in rows_by_var.values()]).astype(str)))
+    
+    # one (names x dates) block per variable, raveled row by row it already is the long layout sorted by (NAME, DATE)
+    values = {}
+    for var, (var_names, rows) in rows_by_var.items():
+        block = np.full((len(names), len(dates)), np.nan)
+        block[names.get_indexer(var_names.astype(str))] = df.loc[rows, date_cols].to_numpy(dtype=float)
+        values[var] = block.ravel()
+    
+    keep = np.zeros(len(names)*len(dates), dtype=bool)
+    for var_values in values.values():
+        keep |= ~np.isnan(var_values)
+    
+    out = pd.DataFrame({"NAME":pd.Categorical.from_codes(np.repeat(np.arange(len(names), dtype=np.int32), len(dates))[keep], categories=names), 
+                        "DATE":np.tile(dates.to_numpy(), len(names))[keep]})
+    for var, var_values in values.items():
+        out[var] = var_values[keep]
+    
+    return out
+
+
+def TransformReturnsFast(df, df_characteristic, old=False, panel=False):
+    '''Same as TransformReturns, but reshapes with WideToLong instead of melt + pivot_table. Firm characteristics are attached from 
+    the first row of each NAME in df_characteristic. With panel=True the result is a MakePanel panel, otherwise NAME holds strings 
+    and DATE holds dates as in TransformReturns.'''
+    
+    if old==True:
+        out = WideToLong(df, "Retrieving...", ["PRICE INDEX", "TOT RETURN IND"])
+    else:
+        out = WideToLong(df, "Name", ["PRICE INDEX"], drop_cols=["CURRENCY"])
+    
+    # looking the characteristics up once per firm instead of merging on the long frame
+    characteristics = df_characteristic[['NAME', 'CTRY_OF_DOM_NAME', 'BOURSE_NAME']].drop_duplicates(subset="NAME").set_index("NAME")
+    codes = out["NAME"].cat.codes.to_numpy()
+    for col in ['CTRY_OF_DOM_NAME', 'BOURSE_NAME']:
+        firm_values = characteristics[col].reindex(out["NAME"].cat.categories)
+        # in a panel they stay categorical, which stores one small code per row instead of one object
+        out[col] = pd.Categorical(firm_values)[codes] if panel else firm_values.to_numpy()[codes]
+    
+    if not panel:
+        out["NAME"] = out["NAME"].cat.categories.to_numpy()[codes]
+        out["DATE"] = out["DATE"].dt.date
+    
+    return out
+
+
+def TransformIndicesFast(df, weekly=False, panel=False):
+    '''Same as TransformIndices, but reshapes with WideToLong instead of melt + pivot_table.'''
+    
+    drop_cols = ['CURRENCY', 'MSEFLA$', 'NA'] if weekly==True else ['CURRENCY']
+    out = WideToLong(df, "Name", ["PRICE INDEX"], drop_cols=drop_cols)
+    
+    if not panel:
+        out["NAME"] = out["NAME"].cat.categories.to_numpy()[out["NAME"].cat.codes.to_numpy()]
+        out["DATE"] = out["DATE"].dt.date
+    
+    return out
+
+
+def CompareReshapeMemory(df, df_characteristic=None, old=False, weekly=False):
+    '''Reports the peak traced memory and the run time of the melt + pivot_table reshape and of WideToLong on the same wide export. 
+    Returns are reshaped if df_characteristic is given, indices otherwise.'''
+    
+    if df_characteristic is not None:
+        funcs = {"pivot_table":lambda wide: TransformReturns(wide, df_characteristic, old), 
+                 "WideToLong":lambda wide: TransformReturnsFast(wide, df_characteristic, old)}
+    else:
+        funcs = {"pivot_table":lambda wide: TransformIndices(wide, weekly), 
+                 "WideToLong":lambda wide: TransformIndicesFast(wide, weekly)}
+    
+    # measured once, before TransformIndices adds and drops columns of its copy
+    input_mb = df.memory_usage(deep=True).sum()/1024**2
+    
+    rows = []
+    for name, func in funcs.items():
+        # TransformIndices changes its input in place, so every run gets its own copy made before tracing starts
+        wide = df.copy()
+        
+        tracemalloc.start()
+        start = perf_counter()
+        func(wide)
+        seconds = perf_counter() - start
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        
+        rows.append({"METHOD":name, "PEAK_MB":peak/1024**2, "SECONDS":seconds, "INPUT_MB":input_mb})
+    
+    return pd.DataFrame(rows)
         
 def MakeReturnsInd(df_ind):
     # creating monthly returns for indices
@@ -255,6 +1153,9 @@ def MakeReturnsInd(df_ind):
     return df_ind
 
 def MakeReturns(df):
+    is_panel = IsSortedPanel(df)
+    name_dtype = df["NAME"].dtype
+    
     # creating percentage returns for equities
     df['STOCK_PCT_RETURN'] = df.groupby(by='NAME')['PRICE INDEX'].apply(pd.Series.pct_change).reset_index()['PRICE INDEX']
     df["LOG_IND"] = np.log(1+df["PRICE INDEX"].astype(float))
@@ -266,17 +1167,99 @@ def MakeReturns(df):
     full_index.columns = ["NAME", "DATE"]
 
     df = full_index.merge(df, how="left", on=['NAME', 'DATE'])
+    
+    # a MakePanel panel stays one (categorical NAME, sorted by NAME and DATE), the product/merge gives plain names back
+    if is_panel:
+        df["NAME"] = df["NAME"].astype(name_dtype)
+        df = df.sort_values(["NAME", "DATE"], ignore_index=True)
 
     return df
 
-def AbnormalReturns(df_ret, df_ind,  market_dict, exchange_dict, training_start_date, training_end_date, ret_variable, ind_variable):
+def IsSortedPanel(df):
+    '''Checks whether a frame already is a MakePanel panel: categorical NAME, datetime64 DATE and sorted by (NAME, DATE).'''
+    
+    if not (isinstance(df["NAME"].dtype, pd.CategoricalDtype) and is_datetime64_any_dtype(df["DATE"])):
+        return False
+    
+    codes = df["NAME"].cat.codes.to_numpy()
+    dates = df["DATE"].to_numpy()
+    
+    return bool(np.all((codes[1:] > codes[:-1]) | ((codes[1:] == codes[:-1]) & (dates[1:] >= dates[:-1]))))
+
+
+def MakeReturnsFast(df, prefix="STOCK", keep_cols=("CTRY_OF_DOM_NAME", "BOURSE_NAME"), balance=True):
+    '''Computes <prefix>_PCT_RETURN and <prefix>_LOG_RETURN per firm from PRICE INDEX in one vectorized pass over a (NAME, DATE) sorted panel, 
+    and with balance=True puts every firm on the full set of dates with a reindex. Covers MakeReturns (the defaults) and 
+    MakeReturnsInd (prefix="INDEX", keep_cols=(), balance=False).
+    
+    Unlike MakeReturns, the log return is log(P_t / P_t-1) rather than the difference of log(1 + P), and the returns are computed on 
+    the sorted rows directly, so they never depend on the row order of the input.'''
+    
+    panel = df[["NAME", "DATE", "PRICE INDEX", *keep_cols]]
+    if not IsSortedPanel(panel):
+        panel = MakePanel(panel)
+    
+    # a duplicated (NAME, DATE) would make the balanced grid ambiguous, the notebook drops them anyway
+    panel = panel.drop_duplicates(subset=["NAME", "DATE"])
+    
+    codes = panel["NAME"].cat.codes.to_numpy()
+    prices = panel["PRICE INDEX"].to_numpy(dtype=float)
+    
+    # the previous price is only valid within the same firm
+    prev_prices = np.r_[np.nan, prices[:-1]]
+    prev_prices[np.r_[True, codes[1:] != codes[:-1]]] = np.nan
+    
+    with np.errstate(divide="ignore", invalid="ignore"):
+        pct_return = prices / prev_prices - 1
+        log_return = np.log(prices / prev_prices)
+    
+    out = pd.DataFrame({"NAME":panel["NAME"].to_numpy(), 
+                        "DATE":panel["DATE"].to_numpy(), 
+                        f"{prefix}_PCT_RETURN":pct_return, 
+                        f"{prefix}_LOG_RETURN":log_return})
+    
+    if balance:
+        names = panel["NAME"].cat.remove_unused_categories().cat.categories
+        grid = pd.MultiIndex.from_product([names, np.unique(panel["DATE"].to_numpy())], names=["NAME", "DATE"])
+        out = out.set_index(["NAME", "DATE"]).reindex(grid).reset_index()
+        out["NAME"] = out["NAME"].astype(panel["NAME"].dtype)
+    
+    # firm characteristics are constant, so the rows added by the grid get them too
+    firm_info = panel.drop_duplicates(subset="NAME").set_index("NAME")
+    for i, col in enumerate(keep_cols):
+        out.insert(1+i, col, out["NAME"].map(firm_info[col]).astype(panel[col].dtype))
+    
+    return out
+
+
+def FirmRows(df, name, is_panel):
+    '''The rows of one firm, with PanelSlice if df is a MakePanel panel and with a mask otherwise.'''
+    
+    if is_panel:
+        if name not in df["NAME"].cat.categories:
+            return df.iloc[0:0]
+        return PanelSlice(df, name)
+    
+    return df[df['NAME'] == name]
+
 
-    df_ret = df_ret[df_ret["DATE"] != datetime.strptime(training_start_date, '%Y-%m-%d').date()]
-    df_ind = df_ind[df_ind["DATE"] != datetime.strptime(training_start_date, '%Y-%m-%d').date()]
+def AbnormalReturns(df_ret, df_ind,  market_dict, exchange_dict, training_start_date, training_end_date, ret_variable, ind_variable):
 
     # set the estimation window
     date_start = datetime.strptime(training_start_date, '%Y-%m-%d').date()
     date_end = datetime.strptime(training_end_date, '%Y-%m-%d').date()
+    
+    # panels from MakePanel hold datetime64 dates, which are compared with timestamps instead
+    if is_datetime64_any_dtype(df_ret["DATE"]):
+        date_start = pd.Timestamp(date_start)
+        date_end = pd.Timestamp(date_end)
+
+    df_ret = df_ret[df_ret["DATE"] != date_start]
+    df_ind = df_ind[df_ind["DATE"] != date_start]
+    
+    # MakePanel panels are sliced per company by binary search instead of a mask over the whole frame
+    ret_panel = IsSortedPanel(df_ret)
+    ind_panel = IsSortedPanel(df_ind)
 
     company_array = df_ret[['NAME', 'CTRY_OF_DOM_NAME', "BOURSE_NAME"]].drop_duplicates().values
     
@@ -306,8 +1289,11 @@ def AbnormalReturns(df_ret, df_ind,  market_dict, exchange_dict, training_start_
         else:
             market = market_dict[cntry]
         
-        est_data_comp = df_ret[(df_ret['NAME']==company) & (df_ret["DATE"] > date_start) & (df_ret["DATE"] < date_end)]
-        est_data_ind = df_ind[(df_ind['NAME'] == market) & (df_ind['DATE'] > date_start) & (df_ind['DATE']< date_end)].reset_index(drop=True).set_index(est_data_comp.index)
+        comp_rows = FirmRows(df_ret, company, ret_panel)
+        ind_rows = FirmRows(df_ind, market, ind_panel)
+        
+        est_data_comp = comp_rows[(comp_rows["DATE"] > date_start) & (comp_rows["DATE"] < date_end)]
+        est_data_ind = ind_rows[(ind_rows['DATE'] > date_start) & (ind_rows['DATE']< date_end)].reset_index(drop=True).set_index(est_data_comp.index)
         est_data_ind = sm.add_constant(est_data_ind)
         
         if  est_data_comp[ret_variable].isna().sum()>0:
@@ -316,15 +1302,545 @@ def AbnormalReturns(df_ret, df_ind,  market_dict, exchange_dict, training_start_
         
         reg = sm.OLS(est_data_comp[ret_variable], est_data_ind[['const', ind_variable]]).fit(cov_type="HC3")
         
-        pred_data_ind = df_ind[(df_ind['NAME'] == market) & (df_ind['DATE'] >= date_end)].reset_index(drop=True)
+        pred_data_ind = ind_rows[(ind_rows['DATE'] >= date_end)].reset_index(drop=True)
         pred_data_ind = sm.add_constant(pred_data_ind)
         
         
         predicted = reg.predict(pred_data_ind[['const', ind_variable]])
         predicted.name = 'NORMAL_RETURN'
-        predicted = predicted.set_axis(data_abnormal_returns.loc[data_abnormal_returns['NAME']== company, 'NORMAL_RETURN'].index)
+        pred_index = FirmRows(data_abnormal_returns, company, ret_panel).index
+        predicted = predicted.set_axis(pred_index)
+        
+        data_abnormal_returns.loc[pred_index, 'NORMAL_RETURN'] = predicted
+    
+    return data_abnormal_returns
+    
+
+def MarketFor(cntry, exchange, market_dict, exchange_dict):
+    '''Picks the market index of a company the same way AbnormalReturns does, NA if the company is skipped.'''
+    
+    market = market_dict[np.nan if pd.isna(cntry) else cntry]
+    
+    if market in ["NA"]:
+        market = exchange_dict[np.nan if pd.isna(exchange) else exchange]
+    
+    if market in ["NA", "MSCI WORLD U$"]:
+        return pd.NA
+    
+    return market
+
+
+def BatchedOLS(X, Y, mask):
+    '''Fits one OLS regression per firm at once. X is (firms, obs, regressors), Y and mask are (firms, obs) and observations 
+    where mask is False are left out. Returns the coefficients, their HC3 covariance matrices and the number of observations.'''
+    
+    X = np.where(mask[..., None], X, 0.0)
+    Y = np.where(mask, Y, 0.0)
+    
+    # pinv like statsmodels, so a singular design gives the minimum-norm solution instead of an error
+    XtX_inv = np.linalg.pinv(np.einsum("ntk,ntl->nkl", X, X))
+    params = np.einsum("nkl,nl->nk", XtX_inv, np.einsum("ntk,nt->nk", X, Y))
+    
+    resid = np.where(mask, Y - np.einsum("ntk,nk->nt", X, params), 0.0)
+    leverage = ((X @ XtX_inv) * X).sum(axis=-1)
+    
+    # HC3: squared residuals scaled by (1 - leverage)^2, masked observations have zero residual and zero leverage
+    weights = resid**2 / (1 - leverage)**2
+    meat = np.einsum("ntk,nt,ntl->nkl", X, weights, X)
+    cov = XtX_inv @ meat @ XtX_inv
+    
+    return params, cov, mask.sum(axis=1)
+
+
+def FitFirmModels(est, y_col, x_cols):
+    '''Fits y_col on a constant and x_cols for every NAME of a long estimation frame with BatchedOLS and returns one row 
+    of coefficients ("const" and x_cols), HC3 standard errors ("<name>_SE") and N_OBS per firm. Firms with a missing y_col are left out.'''
+    
+    est = est.loc[~est["NAME"].isin(est.loc[est[y_col].isna(), "NAME"])]
+    
+    firm_codes, firm_names = pd.factorize(est["NAME"])
+    date_codes, dates = pd.factorize(est["DATE"])
+    
+    param_names = ["const"] + list(x_cols)
+    
+    X = np.zeros((len(firm_names), len(dates), len(param_names)))
+    Y = np.zeros((len(firm_names), len(dates)))
+    mask = np.zeros((len(firm_names), len(dates)), dtype=bool)
+    
+    X[firm_codes, date_codes, 0] = 1.0
+    X[firm_codes, date_codes, 1:] = est[list(x_cols)].to_numpy(dtype=float)
+    Y[firm_codes, date_codes] = est[y_col].to_numpy(dtype=float)
+    # observations with a missing regressor are left out of the firm's regression
+    mask[firm_codes, date_codes] = ~np.isnan(X[firm_codes, date_codes]).any(axis=1)
+    
+    params, cov, n_obs = BatchedOLS(X, Y, mask)
+    
+    df = pd.DataFrame(params, columns=param_names, index=pd.Index(firm_names, name="NAME"))
+    se = np.sqrt(np.diagonal(cov, axis1=1, axis2=2))
+    for i, name in enumerate(param_names):
+        df[name + "_SE"] = se[:, i]
+    df["N_OBS"] = n_obs
+    
+    return df
+
+
+def AlignMarketReturns(df_ret, df_ind, market_dict, exchange_dict, ret_variable, ind_variable):
+    '''Puts the return of each company (Y) next to the return of its market index on the same date (X), in the row order of df_ret 
+    and with datetime64 dates. MARKET and X are missing for the companies that AbnormalReturns skips. Also returns the market of each company.'''
+    
+    companies = df_ret[['NAME', 'CTRY_OF_DOM_NAME', "BOURSE_NAME"]].drop_duplicates(subset="NAME", keep="last")
+    markets = pd.Series([MarketFor(cntry, exchange, market_dict, exchange_dict) for cntry, exchange in zip(companies["CTRY_OF_DOM_NAME"], companies["BOURSE_NAME"])], 
+                        index=companies["NAME"].values).dropna()
+    
+    ret = pd.DataFrame({"NAME":df_ret["NAME"].values, "DATE":pd.to_datetime(df_ret["DATE"]).values, "Y":df_ret[ret_variable].astype(float).values})
+    ret["MARKET"] = ret["NAME"].map(markets)
+    
+    ind = pd.DataFrame({"MARKET":df_ind["NAME"].values, "DATE":pd.to_datetime(df_ind["DATE"]).values, "X":df_ind[ind_variable].astype(float).values})
+    ind = ind.drop_duplicates(subset=["MARKET", "DATE"])
+    
+    # a left merge keeps the row order of df_ret
+    ret = ret.merge(ind, how="left", on=["MARKET", "DATE"])
+    
+    return ret, markets
+
+
+def ReadFactors(path, date_col="DATE", scale=1.0):
+    '''Reads a local CSV of factor returns (one date column and one column per factor, e.g. SMB, HML, MOM) for AbnormalReturnsFast. 
+    The factor returns are multiplied by scale, e.g. 0.01 for files in percent.'''
+    
+    df = pd.read_csv(path)
+    df = df.rename(columns={date_col:"DATE"})
+    df["DATE"] = pd.to_datetime(df["DATE"])
+    
+    factor_cols = [col for col in df.columns if col != "DATE"]
+    df[factor_cols] = df[factor_cols].astype(float) * scale
+    
+    return df
+
+
+def AbnormalReturnsFast(df_ret, df_ind, market_dict, exchange_dict, training_start_date, training_end_date, ret_variable, ind_variable, return_params=False, df_factors=None):
+    '''Same as AbnormalReturns, but estimates the market model of every company at once with batched least squares (HC3 standard errors) 
+    and predicts NORMAL_RETURN for the whole prediction window in one pass. With return_params=True the fitted parameters are returned as well.
+    
+    If df_factors (a DATE column plus one column per factor, see ReadFactors) is given, the model is extended to a multi-factor one: 
+    the market index from market_dict/exchange_dict stays the market factor and the other factors are added as regressors.'''
+    
+    date_start = pd.Timestamp(training_start_date)
+    date_end = pd.Timestamp(training_end_date)
+    
+    ret, markets = AlignMarketReturns(df_ret, df_ind, market_dict, exchange_dict, ret_variable, ind_variable)
+    
+    x_cols = ["X"]
+    if df_factors is not None:
+        factors = df_factors.assign(DATE=pd.to_datetime(df_factors["DATE"])).drop_duplicates(subset="DATE")
+        x_cols += [col for col in factors.columns if col != "DATE"]
+        ret = ret.merge(factors, how="left", on="DATE")
+    
+    est = ret.loc[ret["MARKET"].notna() & (ret["DATE"] > date_start) & (ret["DATE"] < date_end)]
+    
+    params = FitFirmModels(est, "Y", x_cols)
+    
+    # the whole prediction window at once instead of one prediction per company
+    pred = ret.loc[ret["DATE"] >= date_end]
+    coefs = params[["const"] + x_cols].reindex(pred["NAME"]).to_numpy()
+    design = np.column_stack([np.ones(len(pred)), pred[x_cols].to_numpy(dtype=float)])
+    normal_return = np.einsum("ij,ij->i", coefs, design)
+    
+    data_abnormal_returns = df_ret[(ret["DATE"] >= date_end).values].copy()
+    data_abnormal_returns['NORMAL_RETURN'] = normal_return
+    
+    if return_params:
+        params = params.rename(columns={"X":ind_variable, "X_SE":ind_variable + "_SE"})
+        params.insert(0, "MARKET", markets.reindex(params.index).values)
+        return data_abnormal_returns, params
+    
+    return data_abnormal_returns
+
+
+def AbnormalReturnsIncremental(df, df_ind, market_dict, exchange_dict, training_start_date, training_end_date, state_dir, ret_variable="STOCK_LOG_RETURN", ind_variable="INDEX_LOG_RETURN", df_factors=None):
+    '''Incremental MakeReturnsFast + AbnormalReturnsFast for repeated price pulls. df and df_ind are the long price panels (output of 
+    TransformReturnsFast and TransformIndicesFast), ret_variable and ind_variable are columns made by MakeReturnsFast. 
+    
+    The fitted parameters of every company are kept in state_dir with a hash of the company's estimation-window data and the last date 
+    of the panel. On the next call the returns are only computed for the estimation window and the dates after that last date, only the 
+    companies whose estimation-window data changed (revised prices, a new company, a different market) are refitted, and only the new 
+    dates are returned with a NORMAL_RETURN. A different estimation window, return variable or set of factors starts from scratch.'''
+    
+    date_start = pd.Timestamp(training_start_date)
+    date_end = pd.Timestamp(training_end_date)
+    
+    if not exists(state_dir):
+        makedirs(state_dir)
+    state_path = state_dir + "/state.json"
+    params_path = state_dir + "/params.arrow"
+    
+    x_cols = ["X"] + ([col for col in df_factors.columns if col != "DATE"] if df_factors is not None else [])
+    setup = {"training_start_date":str(date_start), "training_end_date":str(date_end), 
+             "ret_variable":ret_variable, "ind_variable":ind_variable, "x_cols":x_cols}
+    
+    state = {}
+    if exists(state_path):
+        with open(state_path, "r") as file:
+            state = load(file)
+    
+    if (state.get("setup") == setup) and exists(params_path):
+        old_params = ReadArrow(params_path).set_index("NAME").rename(columns={ind_variable:"X", ind_variable + "_SE":"X_SE"})
+        last_date = pd.Timestamp(state["last_date"])
+    else:
+        old_params = None
+        last_date = None
+    
+    def recent_returns(panel, **kwargs):
+        # the estimation window and the new dates, each date with the one before it so that the first return has a previous price
+        panel_dates = pd.to_datetime(panel["DATE"])
+        dates = np.unique(panel_dates.to_numpy())
+        needed = ((dates > date_start) & (dates < date_end)) | ((dates >= date_end) & ((dates > last_date) if last_date is not None else True))
+        keep = needed | np.r_[needed[1:], False]
         
-        data_abnormal_returns.loc[data_abnormal_returns['NAME']== company, 'NORMAL_RETURN'] = predicted
+        return MakeReturnsFast(panel.loc[panel_dates.isin(dates[keep]).to_numpy()], **kwargs)
+    
+    ret = recent_returns(df)
+    ind = recent_returns(df_ind, prefix="INDEX", keep_cols=(), balance=False)
+    
+    aligned, _ = AlignMarketReturns(ret, ind, market_dict, exchange_dict, ret_variable, ind_variable)
+    if df_factors is not None:
+        factors = df_factors.assign(DATE=pd.to_datetime(df_factors["DATE"])).drop_duplicates(subset="DATE")
+        aligned = aligned.merge(factors, how="left", on="DATE")
+    
+    est = aligned.loc[aligned["MARKET"].notna() & (aligned["DATE"] > date_start) & (aligned["DATE"] < date_end)]
+    
+    # one hash per company, the sum of its row hashes (the rows include the date and are sorted by NAME)
+    row_hash = pd.util.hash_pandas_object(est[["DATE", "MARKET", "Y", *x_cols]], index=False).to_numpy()
+    firm_codes, firm_names = pd.factorize(est["NAME"])
+    starts = np.flatnonzero(np.r_[True, firm_codes[1:] != firm_codes[:-1]])
+    est_hash = pd.Series(np.add.reduceat(row_hash, starts) if len(starts) else np.array([], dtype=np.uint64), 
+                         index=np.asarray(firm_names[firm_codes[starts]], dtype=object))
+    
+    if old_params is None:
+        changed = est_hash.index
+    else:
+        changed = est_hash.index[est_hash.to_numpy() != old_params["EST_HASH"].reindex(est_hash.index).to_numpy()]
+    
+    refit = FitFirmModels(est.loc[est["NAME"].isin(changed)], "Y", x_cols)
+    refit.index = pd.Index(np.asarray(refit.index, dtype=object), name="NAME")
+    refit["EST_HASH"] = est_hash.reindex(refit.index).to_numpy()
+    
+    params = refit
+    if old_params is not None:
+        # companies without estimation-window data anymore are dropped
+        kept = old_params.loc[old_params.index.isin(est_hash.index) & ~old_params.index.isin(changed)]
+        params = pd.concat([kept, refit])
+    
+    new = (aligned["DATE"] >= date_end).to_numpy()
+    if last_date is not None:
+        new = new & (aligned["DATE"] > last_date).to_numpy()
+    
+    pred = aligned.loc[new]
+    coefs = params[["const"] + x_cols].reindex(pred["NAME"].astype(object)).to_numpy()
+    design = np.column_stack([np.ones(len(pred)), pred[x_cols].to_numpy(dtype=float)])
+    
+    data_abnormal_returns = ret.loc[new].copy()
+    data_abnormal_returns['NORMAL_RETURN'] = np.einsum("ij,ij->i", coefs, design)
+    
+    WriteArrow(params.rename(columns={"X":ind_variable, "X_SE":ind_variable + "_SE"}).reset_index(), params_path)
+    with open(state_path + ".tmp", "w") as file:
+        dump({"setup":setup, "last_date":str(pd.to_datetime(df["DATE"]).max())}, file)
+    replace(state_path + ".tmp", state_path)
+    
+    print(f"Refitted {len(refit)} of {len(params)} companies, {data_abnormal_returns['DATE'].nunique()} new dates")
     
     return data_abnormal_returns
-    
\ No newline at end of file
+
+
+def EventStudy(df_ret, df_ind, events, market_dict, exchange_dict, ret_variable, ind_variable, est_length=120, gap=10, window=(-10, 20), min_obs=60):
+    '''Computes market-model abnormal returns around firm-specific events (an events table with NAME and EVENT_DATE). The event day is 
+    the first trading day of the firm on or after EVENT_DATE, each event is estimated on the est_length trading days ending gap days 
+    before it and abnormal returns are returned for the days window[0]..window[1] relative to the event day.
+    
+    The parameters of all events come from cumulative sums over the sorted panel, so every estimation window costs a few differences 
+    instead of a regression. Returns the abnormal returns (one row per event and day) and the parameters of each event, including the 
+    residual variance and the estimation-window moments of X needed for standardized tests. Events with fewer than min_obs usable 
+    estimation days get missing parameters.'''
+    
+    ret, _ = AlignMarketReturns(df_ret, df_ind, market_dict, exchange_dict, ret_variable, ind_variable)
+    ret = ret.loc[ret["MARKET"].notna()].sort_values(["NAME", "DATE"], kind="stable", ignore_index=True)
+    
+    codes, names = pd.factorize(ret["NAME"], sort=True)
+    dates = ret["DATE"].to_numpy()
+    y = ret["Y"].to_numpy(dtype=float)
+    x = ret["X"].to_numpy(dtype=float)
+    
+    valid = ~(np.isnan(y) | np.isnan(x))
+    y0 = np.where(valid, y, 0.0)
+    x0 = np.where(valid, x, 0.0)
+    
+    # prefix sums with a leading zero, the sum over the rows [a, b) is S[b] - S[a]
+    S1, Sx, Sy, Sxx, Sxy, Syy = (np.concatenate([[0.0], np.cumsum(v)]) for v in (valid, x0, y0, x0*x0, x0*y0, y0*y0))
+    
+    block_start = np.searchsorted(codes, np.arange(len(names)), side="left")
+    block_end = np.searchsorted(codes, np.arange(len(names)), side="right")
+    
+    ev = events[["NAME", "EVENT_DATE"]].reset_index(drop=True)
+    ev_code = names.get_indexer(ev["NAME"])
+    ev_found = ev_code >= 0
+    ev_code = np.where(ev_found, ev_code, 0)
+    lo = block_start[ev_code]
+    hi = block_end[ev_code]
+    
+    # (firm, day) folded into one sorted integer key, so every event day is found with a single searchsorted
+    days = dates.astype("datetime64[D]").astype(np.int64)
+    key = codes.astype(np.int64) * 10_000_000 + days
+    ev_days = pd.to_datetime(ev["EVENT_DATE"]).to_numpy().astype("datetime64[D]").astype(np.int64)
+    t0 = np.searchsorted(key, ev_code.astype(np.int64) * 10_000_000 + ev_days, side="left")
+    ev_found &= t0 < hi
+    
+    a = np.clip(t0 - gap - est_length, lo, None)
+    b = np.clip(t0 - gap, lo, None)
+    
+    n = S1[b] - S1[a]
+    sx, sy = Sx[b] - Sx[a], Sy[b] - Sy[a]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        mean_x, mean_y = sx / n, sy / n
+        cxx = (Sxx[b] - Sxx[a]) - sx * mean_x
+        cxy = (Sxy[b] - Sxy[a]) - sx * mean_y
+        cyy = (Syy[b] - Syy[a]) - sy * mean_y
+        beta = cxy / cxx
+        alpha = mean_y - beta * mean_x
+        sigma2 = (cyy - beta * cxy) / (n - 2)
+    
+    fitted = ev_found & (n >= min_obs)
+    alpha, beta, sigma2, mean_x, cxx = (np.where(fitted, v, np.nan) for v in (alpha, beta, sigma2, mean_x, cxx))
+    
+    params = pd.DataFrame({"EVENT_ID":ev.index.to_numpy(), "NAME":ev["NAME"].to_numpy(), "EVENT_DATE":ev["EVENT_DATE"].to_numpy(), 
+                           "EVENT_DAY":np.where(ev_found, dates[np.clip(t0, 0, len(dates)-1)], np.datetime64("NaT")), 
+                           "ALPHA":alpha, "BETA":beta, "SIGMA2":sigma2, "N_OBS":np.where(ev_found, n, 0).astype(int), 
+                           "EST_MEAN_X":mean_x, "EST_SXX":cxx})
+    
+    # all event windows in one gather
+    rel_days = np.arange(window[0], window[1]+1)
+    idx = t0[:, None] + rel_days[None, :]
+    inside = fitted[:, None] & (idx >= lo[:, None]) & (idx < hi[:, None])
+    
+    event_ids, rel_pos = np.nonzero(inside)
+    rows = idx[event_ids, rel_pos]
+    normal_return = alpha[event_ids] + beta[event_ids] * x[rows]
+    
+    ars = pd.DataFrame({"EVENT_ID":event_ids, 
+                        "NAME":ev["NAME"].to_numpy()[event_ids], 
+                        "EVENT_DATE":ev["EVENT_DATE"].to_numpy()[event_ids], 
+                        "REL_DAY":rel_days[rel_pos], 
+                        "DATE":dates[rows], 
+                        "RETURN":y[rows], 
+                        "MARKET_RETURN":x[rows], 
+                        "NORMAL_RETURN":normal_return, 
+                        "ABNORMAL_RETURN":y[rows] - normal_return})
+    
+    return ars, params
+
+
+def EventWindowStats(ars, params, windows=((-1, 1), (0, 5), (0, 20)), log_returns=False):
+    '''Computes CAR, BHAR and the standardized CAR of every event for every window (relative days, both ends included) from the 
+    output of EventStudy, and the cross-sectional t-test, Patell Z and BMP t of the mean CAR of each window. With log_returns=True 
+    the returns are log returns and are compounded with exp instead of 1 + r. Events missing a day of a window get no value for it. 
+    A window reaching past the relative days in ars (the window of EventStudy) is an error.'''
+    
+    event_ids = params["EVENT_ID"].to_numpy()
+    rel_min = min(start for start, _ in windows)
+    rel_max = max(end for _, end in windows)
+    
+    if len(ars) == 0 or rel_min < ars["REL_DAY"].min() or rel_max > ars["REL_DAY"].max():
+        raise ValueError(f"windows from {rel_min} to {rel_max} need relative days EventStudy did not return, widen its window")
+    
+    rows = pd.Index(event_ids).get_indexer(ars["EVENT_ID"])
+    cols = ars["REL_DAY"].to_numpy() - rel_min
+    keep = (rows >= 0) & (cols >= 0) & (cols <= rel_max - rel_min)
+    
+    # dense (events x relative days) arrays, days outside the data stay missing
+    def dense(col):
+        out = np.full((len(event_ids), rel_max - rel_min + 1), np.nan)
+        out[rows[keep], cols[keep]] = ars[col].to_numpy(dtype=float)[keep]
+        return out
+    
+    ar = dense("ABNORMAL_RETURN")
+    x = dense("MARKET_RETURN")
+    if log_returns:
+        log_ret, log_normal = dense("RETURN"), dense("NORMAL_RETURN")
+    else:
+        log_ret, log_normal = np.log1p(dense("RETURN")), np.log1p(dense("NORMAL_RETURN"))
+    
+    sigma2 = params["SIGMA2"].to_numpy(dtype=float)
+    n_obs = params["N_OBS"].to_numpy(dtype=float)
+    mean_x = params["EST_MEAN_X"].to_numpy(dtype=float)
+    sxx = params["EST_SXX"].to_numpy(dtype=float)
+    
+    # prefix sums along the relative days, a window [s, e] is P[e+1] - P[s], a window with a missing day has fewer than L valid days
+    def prefix(values):
+        return np.concatenate([np.zeros((len(event_ids), 1)), np.cumsum(np.nan_to_num(values), axis=1)], axis=1)
+    
+    P_valid = prefix(~np.isnan(ar))
+    P_ar, P_log_ret, P_log_normal, P_dx = prefix(ar), prefix(log_ret), prefix(log_normal), prefix(x - mean_x[:, None])
+    
+    event_rows = []
+    stat_rows = []
+    for start, end in windows:
+        s, e = start - rel_min, end - rel_min + 1
+        length = end - start + 1
+        
+        complete = (P_valid[:, e] - P_valid[:, s]) == length
+        car = np.where(complete, P_ar[:, e] - P_ar[:, s], np.nan)
+        bhar = np.where(complete, np.exp(P_log_ret[:, e] - P_log_ret[:, s]) - np.exp(P_log_normal[:, e] - P_log_normal[:, s]), np.nan)
+        
+        # variance of the summed prediction errors of the market model over the window
+        with np.errstate(divide="ignore", invalid="ignore"):
+            var_car = sigma2 * (length + length**2 / n_obs + (P_dx[:, e] - P_dx[:, s])**2 / sxx)
+            scar = car / np.sqrt(var_car)
+        
+        event_rows.append(pd.DataFrame({"EVENT_ID":event_ids, "NAME":params["NAME"].to_numpy(), "WINDOW":f"[{start},{end}]", 
+                                        "CAR":car, "BHAR":bhar, "SCAR":scar}))
+        
+        ok = ~np.isnan(scar)
+        n = int(ok.sum())
+        with np.errstate(divide="ignore", invalid="ignore"):
+            t_stat = car[ok].mean() / (car[ok].std(ddof=1) / np.sqrt(n))
+            patell_z = scar[ok].sum() / np.sqrt(((n_obs[ok] - 2) / (n_obs[ok] - 4)).sum())
+            bmp_t = scar[ok].mean() / (scar[ok].std(ddof=1) / np.sqrt(n))
+        
+        stat_rows.append({"WINDOW":f"[{start},{end}]", "N":n, 
+                          "MEAN_CAR":car[ok].mean() if n else np.nan, "MEAN_BHAR":np.nanmean(bhar[ok]) if n else np.nan, 
+                          "T_STAT":t_stat, "T_PVALUE":2*stats.t.sf(abs(t_stat), n-1) if n > 1 else np.nan, 
+                          "PATELL_Z":patell_z, "PATELL_PVALUE":2*stats.norm.sf(abs(patell_z)) if n else np.nan, 
+                          "BMP_T":bmp_t, "BMP_PVALUE":2*stats.t.sf(abs(bmp_t), n-1) if n > 1 else np.nan})
+    
+    return pd.concat(event_rows, ignore_index=True), pd.DataFrame(stat_rows)
+
+
+def ResampleChunk(shm_name, n, n_a, method, seed, size):
+    '''Draws size resampled statistics for ResampleTest from the values in the shared memory block shm_name. The first n_a values 
+    are the first group, the rest the second one (none for a one-sample test of the mean).'''
+    
+    shm = SharedMemory(name=shm_name)
+    try:
+        values = np.ndarray((n,), dtype=np.float64, buffer=shm.buf)
+        rng = np.random.default_rng(seed)
+        
+        if n_a == n:
+            if method == "bootstrap":
+                out = values[rng.integers(0, n, (size, n))].mean(axis=1)
+            else:
+                # sign flips, the mean is zero under the null of a symmetric distribution around zero
+                out = (values * rng.choice([-1.0, 1.0], (size, n))).mean(axis=1)
+        else:
+            if method == "bootstrap":
+                out = (values[:n_a][rng.integers(0, n_a, (size, n_a))].mean(axis=1) 
+                       - values[n_a:][rng.integers(0, n - n_a, (size, n - n_a))].mean(axis=1))
+            else:
+                # shuffled group labels
+                perm = rng.permuted(np.tile(np.arange(n), (size, 1)), axis=1)
+                out = values[perm[:, :n_a]].mean(axis=1) - values[perm[:, n_a:]].mean(axis=1)
+        
+        del values
+        return out
+    finally:
+        shm.close()
+
+
+def ResampleTest(values, groups=None, method="bootstrap", n_resamples=10000, n_workers=1, seed=None, chunk_size=1000, alpha=0.05, progress=True):
+    '''Bootstrap or permutation test of the mean of values (e.g. CARs) or, if groups (boolean, same length) is given, of the difference 
+    in means between the True and the False group. The values are put in shared memory once and the resamples are drawn in chunks 
+    of chunk_size over n_workers processes. Every chunk gets its own child of SeedSequence(seed), so the result only depends on seed 
+    and not on n_workers. The permutation test of a single mean flips signs. Returns the statistic, the two-sided p-value and, 
+    for the bootstrap, the percentile confidence interval. An empty sample or group gives NaN instead of a p-value.'''
+    
+    values = np.asarray(values, dtype=np.float64)
+    if groups is not None:
+        groups = np.asarray(groups, dtype=bool)
+        ok = ~np.isnan(values)
+        values = np.concatenate([values[ok & groups], values[ok & ~groups]])
+        n_a = int((ok & groups).sum())
+        statistic = values[:n_a].mean() - values[n_a:].mean() if 0 < n_a < len(values) else np.nan
+    else:
+        values = values[~np.isnan(values)]
+        n_a = len(values)
+        statistic = values.mean() if n_a else np.nan
+    n = len(values)
+    
+    # an empty sample or group has no distribution to test against, every draw would lose against a NaN statistic
+    if (n_a == 0) or (groups is not None and n - n_a == 0) or np.isnan(statistic):
+        return {"METHOD":method, "N":n_a, "N_OTHER":n - n_a if groups is not None else pd.NA, "STATISTIC":np.nan, 
+                "PVALUE":np.nan, "CI_LOW":np.nan, "CI_HIGH":np.nan, "N_RESAMPLES":0}
+    
+    sizes = [min(chunk_size, n_resamples - start) for start in range(0, n_resamples, chunk_size)]
+    seeds = np.random.SeedSequence(seed).spawn(len(sizes))
+    
+    shm = SharedMemory(create=True, size=max(values.nbytes, 1))
+    try:
+        np.ndarray((n,), dtype=np.float64, buffer=shm.buf)[:] = values
+        
+        chunks = [None] * len(sizes)
+        done = 0
+        with ProcessPoolExecutor(max_workers=n_workers) as executor:
+            futures = {executor.submit(ResampleChunk, shm.name, n, n_a, method, chunk_seed, size):i 
+                       for i, (chunk_seed, size) in enumerate(zip(seeds, sizes))}
+            for future in as_completed(futures):
+                chunks[futures[future]] = future.result()
+                done += len(chunks[futures[future]])
+                if progress:
+                    print(f"{method}: {done}/{n_resamples} resamples")
+    finally:
+        shm.close()
+        shm.unlink()
+    
+    draws = np.concatenate(chunks)
+    
+    if method == "bootstrap":
+        # the bootstrap distribution centered on the statistic approximates the null distribution
+        pvalue = (1 + np.sum(np.abs(draws - statistic) >= abs(statistic))) / (1 + n_resamples)
+        ci_low, ci_high = np.quantile(draws, [alpha / 2, 1 - alpha / 2])
+    else:
+        pvalue = (1 + np.sum(np.abs(draws) >= abs(statistic))) / (1 + n_resamples)
+        ci_low, ci_high = np.nan, np.nan
+    
+    return {"METHOD":method, "N":n_a, "N_OTHER":n - n_a if groups is not None else pd.NA, "STATISTIC":statistic, 
+            "PVALUE":pvalue, "CI_LOW":ci_low, "CI_HIGH":ci_high, "N_RESAMPLES":n_resamples}
+
+
+def GreenIndCARTest(df_car, df_green, name_map, car_col="CAR", method="bootstrap", n_resamples=10000, n_workers=1, seed=None, chunk_size=1000, progress=True):
+    '''Resampling tests of the mean CAR and of the difference in mean CAR between companies with a GREEN_IND above and below 
+    the median, per WINDOW if df_car has one (output of EventWindowStats, or any frame with NAME and car_col). 
+    
+    df_green is the output of ComputeGreenInd (or BuildGreenIndPanel), whose NAME is the scraped company name, and name_map links 
+    it to the Datastream NAME of df_car through its NAME and NAME_SCRAPED columns (e.g. the companies sheet). If df_green has 
+    a YEAR column, df_car needs one too and the indices are matched on (NAME, YEAR).'''
+    
+    names = name_map[["NAME", "NAME_SCRAPED"]].dropna().drop_duplicates()
+    green = df_green.rename(columns={"NAME":"NAME_SCRAPED"}).merge(names, how="inner", on="NAME_SCRAPED")
+    
+    keys = ["NAME"]
+    if "YEAR" in green.columns:
+        if "YEAR" not in df_car.columns:
+            raise ValueError("df_green has several years, df_car needs a YEAR column to pick the index of each event")
+        keys = ["NAME", "YEAR"]
+    
+    green = green.dropna(subset=["GREEN_IND"])
+    if green.duplicated(subset=keys).any():
+        raise ValueError(f"more than one GREEN_IND per {keys}, check name_map and df_green")
+    
+    df = df_car.merge(green[keys + ["GREEN_IND"]], how="left", on=keys)
+    if df["GREEN_IND"].isna().all():
+        print("No CAR matched a GREEN_IND, check name_map")
+    if "WINDOW" not in df.columns:
+        df["WINDOW"] = pd.NA
+    
+    rows = []
+    for window, group in df.groupby("WINDOW", sort=False, dropna=False):
+        cars = group[car_col].to_numpy(dtype=float)
+        
+        result = ResampleTest(cars, method=method, n_resamples=n_resamples, n_workers=n_workers, seed=seed, chunk_size=chunk_size, progress=progress)
+        rows.append({"WINDOW":window, "TEST":"MEAN_CAR", **result})
+        
+        has_ind = group["GREEN_IND"].notna().to_numpy()
+        high = (group["GREEN_IND"] > group["GREEN_IND"].median()).to_numpy()
+        result = ResampleTest(cars[has_ind], high[has_ind], method=method, n_resamples=n_resamples, n_workers=n_workers, seed=seed, chunk_size=chunk_size, progress=progress)
+        rows.append({"WINDOW":window, "TEST":"HIGH_MINUS_LOW_GREEN_IND", **result})
+    
+    return pd.DataFrame(rows)
@@ -5,68 +5,327 @@
 import pandas as pd
 import requests
 from bs4 import BeautifulSoup, SoupStrainer
+from bs4.builder import builder_registry
 from fake_useragent import UserAgent
 import os
 from concurrent.futures import ThreadPoolExecutor 
-from itertools import repeat
 import traceback
+import asyncio
+import aiohttp
+import hashlib
+import json
+import time
+import threading
+import sqlite3
+import ast
+
+# lxml is a lot faster than the pure python html.parser, but is not needed
+FAST_PARSER = "lxml" if builder_registry.lookup("lxml") is not None else "html.parser"
 
 # ////////////////////////////////////////////////
 #                       FUNCS
 # ////////////////////////////////////////////////
 
+# headers of the requests based functions, the crawls below set their own
+fake_headers = {"User-Agent":UserAgent().random}
 
 
 
-def pdf_download(link, directory):
-    ua = UserAgent()
-    hdr = {"User-Agent":ua.random}
-    
+
+def pdf_filename(link):
     filename = link.split('/')[-1]
     if not filename.endswith(".pdf"):
         filename = filename + ".pdf"
+    return filename
+
+def file_sha256(path, chunk_size=1024*1024):
+    hasher = hashlib.sha256()
+    with open(path, "rb") as file:
+        for chunk in iter(lambda: file.read(chunk_size), b""):
+            hasher.update(chunk)
+    return hasher
+
+def stream_download(link, directory, session, chunk_size=1024*1024, timeout=60, expected_sha256=None, expected_size=None):
+    # streams the file to <name>.part in chunks (memory stays flat whatever the size), resumes a leftover .part with a Range request,
+    # checks the size (the server's and expected_size) and expected_sha256 and only then renames it to the final name
+    # an existing file is only kept as is if it matches expected_size/expected_sha256, otherwise (e.g. a file cut short by the old 
+    # scraper) it is resumed like a .part, which also checks its size against the server
+    # the existing file stays where it is until the server confirms it is incomplete (206), so a dead link or a failed 
+    # full download leaves it untouched
+    path = directory + "/" + pdf_filename(link)
+    part_path = path + ".part"
+    
+    resume_path = None
+    if os.path.exists(path):
+        size = os.path.getsize(path)
+        if (expected_size is not None) or (expected_sha256 is not None):
+            digest = file_sha256(path, chunk_size).hexdigest() if expected_sha256 is not None else None
+            if (expected_size in (None, size)) and (expected_sha256 in (None, digest)):
+                return {"link":link, "path":path, "status":"exists", "bytes":size, "sha256":digest, "error":None}
+        
+        if (expected_size is not None) and (size >= expected_size):
+            # the right size (or more) but the wrong content, nothing to resume
+            os.remove(path)
+        else:
+            resume_path = path
+    
+    if resume_path is None and os.path.exists(part_path):
+        resume_path = part_path
     
+    response = None
     try:
-        req = requests.get(link, headers=hdr).content
-        with open(directory + "/" + filename, mode="wb") as file:
-            file.write(req)
-    except:
-        traceback.print_exc(file=None)
-        print(f"Where the error ocurred:{directory}")
+        offset = os.path.getsize(resume_path) if resume_path is not None else 0
+        response = session.get(link, headers={"Range":f"bytes={offset}-"} if offset else {}, stream=True, timeout=timeout)
+        
+        complete = False
+        if response.status_code == 416:
+            response.close()
+            total = response.headers.get("Content-Range", "").split("/")[-1]
+            if total.isdigit() and int(total) == offset:
+                # the existing file or .part already has all the bytes
+                complete = True
+            else:
+                # the server does not know the range anymore, start over
+                offset = 0
+                response = session.get(link, stream=True, timeout=timeout)
+        
+        # the file that ends up at path: the .part, or the existing file if the server says it is complete
+        done_path = part_path
+        if complete:
+            done_path = resume_path
+            hasher = file_sha256(done_path, chunk_size)
+            server_size = offset
+        else:
+            with response:
+                response.raise_for_status()
+                
+                hasher = hashlib.sha256()
+                if response.status_code == 206:
+                    total = response.headers.get("Content-Range", "").split("/")[-1]
+                    server_size = int(total) if total.isdigit() else None
+                    if resume_path != part_path:
+                        os.replace(resume_path, part_path)
+                    hasher = file_sha256(part_path, chunk_size)
+                    mode = "ab"
+                else:
+                    # the server sent the whole file
+                    encoded = response.headers.get("Content-Encoding", "identity") != "identity"
+                    server_size = int(response.headers["Content-Length"]) if ("Content-Length" in response.headers) and not encoded else None
+                    offset = 0
+                    mode = "wb"
+                
+                with open(part_path, mode) as file:
+                    for chunk in response.iter_content(chunk_size=chunk_size):
+                        file.write(chunk)
+                        hasher.update(chunk)
+        
+        size = os.path.getsize(done_path)
+        for expected in (server_size, expected_size):
+            if expected is not None and size != expected:
+                # a short file is kept for the next run to resume, a too long one can't be fixed that way
+                if size > expected:
+                    os.remove(done_path)
+                raise IOError(f"expected {expected} bytes, got {size}")
+        
+        digest = hasher.hexdigest()
+        if expected_sha256 is not None and digest != expected_sha256:
+            os.remove(done_path)
+            raise IOError(f"expected sha256 {expected_sha256}, got {digest}")
+        
+        os.replace(done_path, path)
+        return {"link":link, "path":path, "status":"exists" if complete else response.status_code, "bytes":size, "sha256":digest, "error":None}
+    
+    except Exception as e:
         with open("exceptions.log", "a") as logfile:
             traceback.print_exc(file=logfile)
-            print(f"Where the error ocurred:{directory}")
-   
+            logfile.write(f"Where the error ocurred:{directory}\n")
+        print(link, repr(e))
+        return {"link":link, "path":path, "status":response.status_code if response is not None else None, 
+                "bytes":None, "sha256":None, "error":repr(e)}
+
+def download_pdfs(links, directories, max_workers=8, chunk_size=1024*1024, timeout=60, expected_sha256s=None, expected_sizes=None):
+    # one pool of max_workers threads for all the files, every thread keeps its own session (and so its connections)
+    # expected_sha256s/expected_sizes (one per link, None where unknown) are checked before a file is kept
+    local = threading.local()
     
-def scraping_loop(df, dir, scrape_column):
-    # starting the loop for scraping
+    def download(link, directory, expected_sha256, expected_size):
+        if not hasattr(local, "session"):
+            local.session = requests.Session()
+            local.session.headers.update({"User-Agent":UserAgent().random})
+        return stream_download(link, directory, local.session, chunk_size, timeout, expected_sha256, expected_size)
+    
+    if expected_sha256s is None:
+        expected_sha256s = [None]*len(links)
+    if expected_sizes is None:
+        expected_sizes = [None]*len(links)
+    
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        results = list(executor.map(download, links, directories, expected_sha256s, expected_sizes))
+    
+    return pd.DataFrame(results, columns=["link", "path", "status", "bytes", "sha256", "error"])
+
+def company_folder(name):
+    company_folder_dir = name.lower().replace(" ", "_")
+    
+    if any(i in company_folder_dir for i in ("?", "|")):
+        company_folder_dir = company_folder_dir.replace("?", "")
+        company_folder_dir = company_folder_dir.replace("|", "")
+    
+    return company_folder_dir
+
+def link_list(cell):
+    # the links of one company, from a list or from its string form in the csvs, without the "" of a missing recent report
+    # None if the cell is missing (the company page could not be fetched), which is not the same as no links
+    if isinstance(cell, str):
+        cell = ast.literal_eval(cell)
+    elif not isinstance(cell, list):
+        return None
+    return [link for link in cell if link != ""]
+
+def open_manifest(path, create=True):
+    # the crawl state: every company of every site, and every link with the result of its download
+    # done is 1 once the file is on disk, status is the http status of the last try ("exists" if the file was already there)
+    # with create=False a missing manifest is an error instead of a new empty one
+    if not create and not os.path.exists(path):
+        raise FileNotFoundError(f"no crawl manifest at {path}, run scraping.py first")
+    
+    conn = sqlite3.connect(path)
+    conn.executescript('''
+        CREATE TABLE IF NOT EXISTS companies (
+            id INTEGER PRIMARY KEY,
+            site TEXT NOT NULL,
+            name TEXT NOT NULL,
+            industry TEXT,
+            sector TEXT,
+            company_page TEXT NOT NULL,
+            folder TEXT NOT NULL,
+            UNIQUE (site, company_page)
+        );
+        CREATE TABLE IF NOT EXISTS links (
+            id INTEGER PRIMARY KEY,
+            company_id INTEGER NOT NULL REFERENCES companies(id),
+            position INTEGER NOT NULL,
+            url TEXT NOT NULL,
+            path TEXT NOT NULL,
+            done INTEGER NOT NULL DEFAULT 0,
+            status INTEGER,
+            bytes INTEGER,
+            sha256 TEXT,
+            error TEXT,
+            updated_at REAL,
+            UNIQUE (company_id, position)
+        );
+        CREATE INDEX IF NOT EXISTS links_done ON links (done, company_id);
+    ''')
+    return conn
+
+def manifest_add_companies(conn, df, site, dir, links_column, page_column="company page"):
+    # stores (or updates) the companies of df and their download links, returns their ids in the manifest
+    # a link that changed gets downloaded again, the links past the end of a shorter list are dropped
+    company_ids = []
     for index, row in df.iterrows():
+        folder = dir + company_folder(row["name"])
+        conn.execute('''INSERT INTO companies (site, name, industry, sector, company_page, folder) VALUES (?, ?, ?, ?, ?, ?)
+                        ON CONFLICT (site, company_page) DO UPDATE SET name=excluded.name, industry=excluded.industry, 
+                        sector=excluded.sector, folder=excluded.folder''', 
+                     (site, row["name"], row.get("industry"), row.get("sector"), row[page_column], folder))
+        company_id = conn.execute("SELECT id FROM companies WHERE site = ? AND company_page = ?", (site, row[page_column])).fetchone()[0]
+        company_ids.append(company_id)
+        
+        # a company whose links are missing in this crawl keeps the ones (and the downloads) of the last crawl
+        links = link_list(row[links_column])
+        if links is None:
+            continue
+        
+        conn.executemany('''INSERT INTO links (company_id, position, url, path) VALUES (?, ?, ?, ?)
+                            ON CONFLICT (company_id, position) DO UPDATE SET url=excluded.url, path=excluded.path, 
+                            done=CASE WHEN links.url = excluded.url THEN links.done ELSE 0 END''', 
+                         [(company_id, position, link, folder + "/" + pdf_filename(link)) for position, link in enumerate(links)])
+        conn.execute("DELETE FROM links WHERE company_id = ? AND position >= ?", (company_id, len(links)))
+    
+    conn.commit()
+    return company_ids
+
+def manifest_download(conn, company_ids=None, max_workers=8, chunk_size=1024*1024, timeout=60, check_files=True):
+    # downloads exactly the links that are not done (never tried, failed, or with check_files, whose file is gone or changed size) 
+    # for the given companies (all of them if None) and writes the results back to the manifest
+    if check_files:
+        # gone, or not the size that was downloaded
+        changed = [(link_id,) for link_id, path, size in conn.execute("SELECT id, path, bytes FROM links WHERE done = 1") 
+                   if not os.path.exists(path) or (size is not None and os.path.getsize(path) != size)]
+        conn.executemany("UPDATE links SET done = 0 WHERE id = ?", changed)
+    
+    # the size and hash of an earlier download are checked again when the file is redownloaded or found on disk
+    pending = pd.read_sql_query('''SELECT links.id, links.company_id, links.url, links.bytes, links.sha256, companies.folder FROM links 
+                                  JOIN companies ON companies.id = links.company_id WHERE links.done = 0''', conn)
+    if company_ids is not None:
+        pending = pending[pending["company_id"].isin(company_ids)]
+    
+    for folder in pending["folder"].unique():
+        if not os.path.exists(folder):
+            os.makedirs(folder)
+    
+    results = download_pdfs(pending["url"].tolist(), pending["folder"].tolist(), max_workers, chunk_size, timeout, 
+                            [None if pd.isna(sha) else sha for sha in pending["sha256"]], 
+                            [None if pd.isna(size) else int(size) for size in pending["bytes"]])
+    
+    # the status column of the results is float when ints mix with None, "exists" is kept as text
+    def status_value(status):
+        if isinstance(status, str):
+            return status
+        return None if pd.isna(status) else int(status)
+    
+    now = time.time()
+    conn.executemany("UPDATE links SET done = ?, status = ?, bytes = ?, sha256 = ?, error = ?, updated_at = ? WHERE id = ?", 
+                     [(int(pd.isna(error)), status_value(status), None if pd.isna(size) else int(size), 
+                       None if pd.isna(sha) else sha, None if pd.isna(error) else error, now, int(link_id)) 
+                      for link_id, status, size, sha, error in zip(pending["id"], results["status"], results["bytes"], results["sha256"], results["error"])])
+    conn.commit()
+    
+    print(f"{len(results)} files: {int(results['error'].isna().sum())} done, {int(results['error'].notna().sum())} failed")
+    return results
+
+def report_counts(conn, site):
+    # number of report links (and of downloaded files) per company page, for the num_of_reports columns
+    return pd.read_sql_query('''SELECT companies.company_page, COUNT(links.id) AS num_of_reports, COALESCE(SUM(links.done), 0) AS num_downloaded 
+                                FROM companies LEFT JOIN links ON links.company_id = companies.id 
+                                WHERE companies.site = ? GROUP BY companies.id''', conn, params=(site,))
+
+def scraping_loop(df, dir, scrape_column, manifest, site, page_column="company page", max_workers=8):
+    # the companies and their links go to the manifest, then only the files that are missing or failed are downloaded,
+    # all of them through one thread pool
+    company_ids = manifest_add_companies(manifest, df, site, dir, scrape_column, page_column)
+    
+    return manifest_download(manifest, company_ids, max_workers)
+
+def parse_index_page(content, main_link):
+    strainer = SoupStrainer("section", {"class":"category_section"})
 
+    content = BeautifulSoup(content, "html.parser", parse_only=strainer)
 
-        # making a directory for each company 
-        folder_dir = dir
-        company_folder_dir = row["name"].lower().replace(" ", "_")
+    sector_data = content.find("h1")
+    industry_data = content.find_all("span", attrs={"class":"industryName"})
+    company_link_tags = content.find_all("span", attrs={"class":"companyName"})
+
+
+    company_names = []
+    company_links = []
+    company_industry = []
+    for link_num in range(0, len(company_link_tags)):
+        company_names.append(company_link_tags[link_num].contents[0].get_text())
+        company_industry.append(industry_data[link_num].get_text()) 
+        company_links.append(company_link_tags[link_num].contents[0].get("href"))
         
-        if any(i in company_folder_dir for i in ("?", "|")):
-            company_folder_dir = company_folder_dir.replace("?", "")
-            company_folder_dir = company_folder_dir.replace("|", "")
         
-        total_dir = folder_dir + company_folder_dir
-        if os.path.exists(total_dir):
-            continue
         
-        else:    
-            if not os.path.exists(total_dir):
-                os.makedirs(total_dir)
-
-            # if "" on the list, drop it 
-            download_links = eval(row[scrape_column]) 
-            if "" in download_links:
-                download_links.remove("")
-                
-            # download files using multithreading
-            with ThreadPoolExecutor() as executor:
-                executor.map(pdf_download, download_links, repeat(total_dir))
+    temp_df =  pd.DataFrame({
+        "name":company_names, 
+        "industry":company_industry, 
+        "sector": [sector_data.get_text()]*len(company_names),
+        "company page": [main_link + company_link for company_link in company_links]
+    })
+    
+    return temp_df
 
 def get_index(main_link, sector_dirs, df):
     # there's 9 pages of index so that's why the loop goes from 1 to 9
@@ -76,34 +335,34 @@ def get_index(main_link, sector_dirs, df):
         
         source = requests.get(main_link+sector_dirs+f"{i}", headers=fake_headers)
         print(source.status_code)
-        strainer = SoupStrainer("section", {"class":"category_section"})
-
-        content = BeautifulSoup(source.content, "html.parser", parse_only=strainer)
+        
+        temp_df = parse_index_page(source.content, main_link)
+        
+        df = pd.concat([df, temp_df], axis=0, ignore_index=True)
+    return df
 
-        sector_data = content.find("h1")
-        industry_data = content.find_all("span", attrs={"class":"industryName"})
-        company_link_tags = content.find_all("span", attrs={"class":"companyName"})
+def parse_download_links(company_page, main_link):
+    # most recent article
+    recent_soup = BeautifulSoup(company_page, "html.parser", parse_only=SoupStrainer("div", {"class":"most_recent_content_block"}))
 
+    recent_tags = recent_soup.find_all("a", attrs={"class":"btn_form_10k"})
+    if recent_tags:
+        recent_link = main_link + recent_tags[0].get("href")
+    else:
+        recent_link = ""
+        
+    # archived articles
+    archived_soup = BeautifulSoup(company_page, "html.parser", parse_only=SoupStrainer("div", {"class":"archived_report_content_block"}))
+    
+    archived_tags = archived_soup.find_all("span", attrs={"class":"btn_archived view_annual_report"})
 
-        company_names = []
-        company_links = []
-        company_industry = []
-        for link_num in range(0, len(company_link_tags)):
-            company_names.append(company_link_tags[link_num].contents[0].get_text())
-            company_industry.append(industry_data[link_num].get_text()) 
-            company_links.append(company_link_tags[link_num].contents[0].get("href"))
-            
-            
-            
-        temp_df =  pd.DataFrame({
-            "name":company_names, 
-            "industry":company_industry, 
-            "sector": [sector_data.get_text()]*len(company_names),
-            "company page": [main_link + company_link for company_link in company_links]
-        })
+    archived_links = []
+    for report in archived_tags:
+        temp = report.find("a").get("href")
+        archived_links.append(temp)
         
-        df = pd.concat([df, temp_df], axis=0, ignore_index=True)
-    return df
+    links_list = [recent_link] + [link if link.startswith("https://") else main_link + link for link in archived_links ]
+    return links_list
 
 def get_download_links(df, main_link, company_link_col, output_col):
     for company in range(0, len(df)):
@@ -111,183 +370,345 @@ def get_download_links(df, main_link, company_link_col, output_col):
         try:
             company_page = requests.get(df.iloc[company, company_link_col], headers=fake_headers).content
             
-            # most recent article
-            recent_soup = BeautifulSoup(company_page, "html.parser", parse_only=SoupStrainer("div", {"class":"most_recent_content_block"}))
-
-            recent_tags = recent_soup.find_all("a", attrs={"class":"btn_form_10k"})
-            if recent_tags:
-                recent_link = main_link + recent_tags[0].get("href")
-            else:
-                recent_link = ""
-                
-            # archived articles
-            archived_soup = BeautifulSoup(company_page, "html.parser", parse_only=SoupStrainer("div", {"class":"archived_report_content_block"}))
-            
-            archived_tags = archived_soup.find_all("span", attrs={"class":"btn_archived view_annual_report"})
-
-            archived_links = []
-            for report in archived_tags:
-                temp = report.find("a").get("href")
-                archived_links.append(temp)
-                
-            links_list = [recent_link] + [link if link.startswith("https://") else main_link + link for link in archived_links ]
-            df.iat[company, output_col] = links_list
+            df.iat[company, output_col] = parse_download_links(company_page, main_link)
         except Exception as e:
             print(company, e)
     
     return df
 
+def parse_company_data(company_page):
+    # company data
+    return BeautifulSoup(company_page, "html.parser", parse_only=SoupStrainer("div", {"class":"left_section"}))
+
+def parse_year_names(company_page):
+    most_recent_year_name = BeautifulSoup(company_page, "html.parser", parse_only=SoupStrainer("div", {"class":"most_recent_content_block"})).find("span", {"class":"bold_txt"}).text
+    
+    archived_year_names = BeautifulSoup(company_page, "html.parser", parse_only=SoupStrainer("div", {"class":"archived_report_content_block"})).find_all("span", {"class":"heading"})
+    year_names = [year.text for year in archived_year_names]
+    
+    return [most_recent_year_name] + year_names
+
 def get_company_charachteristics(df, main_link, company_link_col, output_col_unstructured, output_col_years):
     for company in range(0, len(df)):
         try:
             company_page = requests.get(df.iloc[company, company_link_col], headers=fake_headers).content 
-            # company data
-            data_soup = BeautifulSoup(company_page, "html.parser", parse_only=SoupStrainer("div", {"class":"left_section"}))
             
-            df.iat[company, output_col_unstructured] = data_soup
+            df.iat[company, output_col_unstructured] = parse_company_data(company_page)
+            df.iat[company, output_col_years] = parse_year_names(company_page)
+            
+
+        
+        except Exception as e:
+            print(company, e)
+    
+    return df
+
+def parse_company_tree(company_page, parser=FAST_PARSER):
+    # one parse of a company page, only the three blocks that are used are kept
+    strainer = SoupStrainer("div", {"class":["left_section", "most_recent_content_block", "archived_report_content_block"]})
+    return BeautifulSoup(company_page, parser, parse_only=strainer)
+
+def links_from_tree(tree, main_link):
+    # same as parse_download_links, from the tree of parse_company_tree
+    recent_tags = [tag for block in tree.find_all("div", {"class":"most_recent_content_block"}) for tag in block.find_all("a", attrs={"class":"btn_form_10k"})]
+    if recent_tags:
+        recent_link = main_link + recent_tags[0].get("href")
+    else:
+        recent_link = ""
+    
+    archived_links = [report.find("a").get("href") for block in tree.find_all("div", {"class":"archived_report_content_block"}) 
+                      for report in block.find_all("span", attrs={"class":"btn_archived view_annual_report"})]
+    
+    return [recent_link] + [link if link.startswith("https://") else main_link + link for link in archived_links ]
+
+def data_from_tree(tree):
+    # the left_section html, i.e. what parse_company_data gives once written to the csv
+    return "".join(str(block) for block in tree.find_all("div", {"class":"left_section"}))
+
+def years_from_tree(tree):
+    # same as parse_year_names, from the tree of parse_company_tree
+    recent_blocks = tree.find_all("div", {"class":"most_recent_content_block"})
+    most_recent_year_name = next(tag for block in recent_blocks for tag in block.find_all("span", {"class":"bold_txt"})).text
+    
+    year_names = [year.text for block in tree.find_all("div", {"class":"archived_report_content_block"}) for year in block.find_all("span", {"class":"heading"})]
+    
+    return [most_recent_year_name] + year_names
+
+def compare_parsers(pages, main_link, parser=FAST_PARSER):
+    # parse time per company page of the five html.parser passes (parse_download_links, parse_company_data, parse_year_names) 
+    # against one parse_company_tree, and whether they give the same column values
+    rows = []
+    for page in pages:
+        start = time.perf_counter()
+        old = [parse_download_links(page, main_link), str(parse_company_data(page))]
+        try:
+            old.append(parse_year_names(page))
+        except Exception:
+            old.append(None)
+        old_time = time.perf_counter() - start
+        
+        start = time.perf_counter()
+        tree = parse_company_tree(page, parser)
+        new = [links_from_tree(tree, main_link), data_from_tree(tree)]
+        try:
+            new.append(years_from_tree(tree))
+        except Exception:
+            new.append(None)
+        new_time = time.perf_counter() - start
+        
+        rows.append({"old_seconds":old_time, "new_seconds":new_time, "same_links":old[0] == new[0], 
+                     "same_characteristics":old[1] == new[1], "same_years":old[2] == new[2]})
+    
+    df = pd.DataFrame(rows)
+    print(f"{len(df)} pages, html.parser x5: {df['old_seconds'].mean()*1000:.2f} ms/page, {parser} x1: {df['new_seconds'].mean()*1000:.2f} ms/page")
+    return df
+
+def page_store_paths(store_dir, url):
+    # the stored page and its validators (ETag, Last-Modified) are keyed by the hash of the url
+    key = hashlib.sha256(url.encode()).hexdigest()
+    return store_dir + "/" + key + ".html", store_dir + "/" + key + ".json"
+
+async def fetch_pages(urls, headers=None, limit_per_host=8, timeout=30, store_dir=None, max_age=None):
+    # one pooled session for all the pages, the connector keeps the connections alive and caps the open ones per host
+    # with store_dir, every page is kept on disk and only revalidated (If-None-Match / If-Modified-Since) on the next crawl,
+    # pages checked less than max_age seconds ago are not requested at all
+    if headers is None:
+        headers = {"User-Agent":UserAgent().random}
+    if store_dir is not None and not os.path.exists(store_dir):
+        os.makedirs(store_dir)
+    
+    counts = {"cache hits":0, "not modified":0, "downloaded":0, "failed":0}
+    
+    connector = aiohttp.TCPConnector(limit_per_host=limit_per_host)
+    async with aiohttp.ClientSession(headers=headers, connector=connector, timeout=aiohttp.ClientTimeout(total=timeout)) as session:
+        
+        async def fetch(url):
+            page_path, meta_path = page_store_paths(store_dir, url) if store_dir is not None else (None, None)
+            
+            meta = {}
+            if store_dir is not None and os.path.exists(meta_path) and os.path.exists(page_path):
+                with open(meta_path, "r") as file:
+                    meta = json.load(file)
             
-            most_recent_year_name = BeautifulSoup(company_page, "html.parser", parse_only=SoupStrainer("div", {"class":"most_recent_content_block"})).find("span", {"class":"bold_txt"}).text
+            if meta and max_age is not None and time.time() - meta["checked_at"] < max_age:
+                counts["cache hits"] += 1
+                with open(page_path, "rb") as file:
+                    return file.read()
             
-            archived_year_names = BeautifulSoup(company_page, "html.parser", parse_only=SoupStrainer("div", {"class":"archived_report_content_block"})).find_all("span", {"class":"heading"})
-            year_names = [year.text for year in archived_year_names]
+            conditional = {}
+            if meta.get("etag"):
+                conditional["If-None-Match"] = meta["etag"]
+            if meta.get("last_modified"):
+                conditional["If-Modified-Since"] = meta["last_modified"]
             
-            df.iat[company, output_col_years] = [most_recent_year_name] + year_names
+            try:
+                async with session.get(url, headers=conditional) as response:
+                    if meta and response.status == 304:
+                        content = None
+                    else:
+                        response.raise_for_status()
+                        content = await response.read()
+                    validators = {"etag":response.headers.get("ETag", meta.get("etag")), 
+                                  "last_modified":response.headers.get("Last-Modified", meta.get("last_modified"))}
+            except Exception as e:
+                print(url, repr(e))
+                counts["failed"] += 1
+                # an old copy is better than nothing
+                if meta:
+                    with open(page_path, "rb") as file:
+                        return file.read()
+                return None
             
+            if content is None:
+                counts["not modified"] += 1
+                with open(page_path, "rb") as file:
+                    content = file.read()
+            else:
+                counts["downloaded"] += 1
+                if store_dir is not None:
+                    with open(page_path + ".tmp", "wb") as file:
+                        file.write(content)
+                    os.replace(page_path + ".tmp", page_path)
+            
+            if store_dir is not None:
+                with open(meta_path + ".tmp", "w") as file:
+                    json.dump({"url":url, **validators, "checked_at":time.time()}, file)
+                os.replace(meta_path + ".tmp", meta_path)
+            
+            return content
+        
+        # same order as urls, None where the request failed
+        contents = await asyncio.gather(*(fetch(url) for url in urls))
+    
+    print(f"{len(urls)} pages: " + ", ".join(f"{value} {key}" for key, value in counts.items()))
+    return contents
 
+def crawl_index(main_link, sector_dirs, df, headers=None, pages=range(1,10), limit_per_host=8, timeout=30, store_dir=None, max_age=None):
+    # same as get_index, but all the index pages are fetched concurrently
+    urls = [main_link+sector_dirs+f"{i}" for i in pages]
+    contents = asyncio.run(fetch_pages(urls, headers, limit_per_host, timeout, store_dir, max_age))
+    
+    temp_dfs = [parse_index_page(content, main_link) for content in contents if content is not None]
+    
+    return pd.concat([df, *temp_dfs], axis=0, ignore_index=True)
+
+def crawl_company_pages(df, main_link, company_link_col, output_col, output_col_unstructured=None, output_col_years=None, headers=None, limit_per_host=8, timeout=30, store_dir=None, max_age=None, parser=FAST_PARSER):
+    # fills the columns of get_download_links and (if given) get_company_charachteristics in one pass over every company page,
+    # the pages are downloaded concurrently and (with store_dir) only once
+    urls = [df.iloc[company, company_link_col] for company in range(0, len(df))]
+    contents = asyncio.run(fetch_pages(urls, headers, limit_per_host, timeout, store_dir, max_age))
+    
+    for company, company_page in enumerate(contents):
+        if company_page is None:
+            continue
+        
+        # each page is parsed once, the columns are filled from the same tree
+        tree = parse_company_tree(company_page, parser)
         
+        try:
+            df.iat[company, output_col] = links_from_tree(tree, main_link)
+        except Exception as e:
+            print(company, e)
+        
+        if output_col_unstructured is None:
+            continue
+        
+        try:
+            df.iat[company, output_col_unstructured] = data_from_tree(tree)
+            df.iat[company, output_col_years] = years_from_tree(tree)
         except Exception as e:
             print(company, e)
     
     return df
 
 
-# ////////////////////////////////////////////////
-#                  FIRST WEBSITE
-# ////////////////////////////////////////////////
+# the crawls only run as a script, importing the module (e.g. in the tests) only gives the functions
+if __name__ == "__main__":
 
-# initial website
-main_link = "https://www.responsibilityreports.com"
+    # ////////////////////////////////////////////////
+    #                  FIRST WEBSITE
+    # ////////////////////////////////////////////////
 
-# link with sectors to collect
-sector_dirs = "/Companies?sect="
+    # initial website
+    main_link = "https://www.responsibilityreports.com"
 
-# fake user agent
-ua = UserAgent()
-fake_headers = {"User-Agent":ua.random}
+    # link with sectors to collect
+    sector_dirs = "/Companies?sect="
 
+    # fake user agent
+    ua = UserAgent()
+    fake_headers = {"User-Agent":ua.random}
 
-# making an empty df before getting the index 
-resp_reports_df = pd.DataFrame({
-    "name":[],
-    "industry":[],
-    "sector":[],
-    "company page":[]
-    })
+
+    # making an empty df before getting the index 
+    resp_reports_df = pd.DataFrame({
+        "name":[],
+        "industry":[],
+        "sector":[],
+        "company page":[]
+        })
 
 
-resp_reports_df = get_index(main_link, sector_dirs, resp_reports_df)
+    resp_reports_df = crawl_index(main_link, sector_dirs, resp_reports_df, fake_headers, store_dir="data/scraping/pages/resp_reports")
         
             
-# making an empty column for the download links
-resp_reports_df["download links"] = pd.NA
-
+    # making an empty column for the download links
+    resp_reports_df["download links"] = pd.NA
+    resp_reports_df["characteristics_dirty"] = pd.NA
+    resp_reports_df["year_lists"] = pd.NA
 
-# getting the download links
-resp_reports_df = get_download_links(resp_reports_df, main_link, 3, 4)
 
+    # getting the download links and the comp charachteristics (one download of each company page)
+    resp_reports_df = crawl_company_pages(resp_reports_df, main_link, 3, 4, 5, 6, fake_headers, store_dir="data/scraping/pages/resp_reports")
 
-resp_reports_df["characteristics_dirty"] = pd.NA
-resp_reports_df["year_lists"] = pd.NA
-# getting the comp charachteristics
-resp_reports_df = get_company_charachteristics(resp_reports_df, main_link, 3, 5, 6)
 
+    # writing to csv
+    # resp_reports_df.to_csv("data/scraping/responsibility_report_links.csv", index=False)
 
-# writing to csv
-# resp_reports_df.to_csv("data/scraping/responsibility_report_links.csv", index=False)
 
+    # re-loading it here so I wouldn't have to repeat the process everytime
+    # resp_reports_df_data = pd.read_csv("data/scraping/responsibility_report_links.csv")
 
-# re-loading it here so I wouldn't have to repeat the process everytime
-# resp_reports_df_data = pd.read_csv("data/scraping/responsibility_report_links.csv")
+    # crawl state (companies, links, downloads)
+    manifest = open_manifest("data/scraping/crawl_manifest.sqlite")
 
-# scraping
-scraping_loop(resp_reports_df, "data/scraping/resp_reports/", "download links")
+    # scraping
+    scraping_loop(resp_reports_df, "data/scraping/resp_reports/", "download links", manifest, "resp_reports")
     
-# quick helper function for returning the list after removing the whitespace
-def remove(x):
-    x.remove("")
-    return x   
-    
-resp_reports_df["num_of_reports"] = [len(remove(eval(obs))) if '' in eval(obs) else len(eval(obs)) for obs in resp_reports_df["download links"]]
+    resp_reports_df["num_of_reports"] = resp_reports_df["company page"].map(report_counts(manifest, "resp_reports").set_index("company_page")["num_of_reports"])
 
-# NOTE
-# about 1400 companies with at least 5 reports, 1000 with at least 6.
-# probably should start taking from 5>= and then subset the scraping for these to see whether I can get a large enough of a dataset from that 
-# later figure it out from there with the ESG measures and such 
+    # NOTE
+    # about 1400 companies with at least 5 reports, 1000 with at least 6.
+    # probably should start taking from 5>= and then subset the scraping for these to see whether I can get a large enough of a dataset from that 
+    # later figure it out from there with the ESG measures and such 
 
 
 
 
-# //////////////////////////////////////////////////////////////////////////////////////////////////
-#                                          SECOND WEBSITE
-# //////////////////////////////////////////////////////////////////////////////////////////////////
+    # //////////////////////////////////////////////////////////////////////////////////////////////////
+    #                                          SECOND WEBSITE
+    # //////////////////////////////////////////////////////////////////////////////////////////////////
 
-# initial website
-main_link = "https://www.annualreports.com/"
+    # initial website
+    main_link = "https://www.annualreports.com/"
 
-# link with sectors to collect
-sector_dirs = "/Companies?sect="
+    # link with sectors to collect
+    sector_dirs = "/Companies?sect="
 
-# fake user agent
-ua = UserAgent()
-fake_headers = {"User-Agent":ua.random}
+    # fake user agent
+    ua = UserAgent()
+    fake_headers = {"User-Agent":ua.random}
 
 
-# get link to each company page 
-annual_reports_df = pd.DataFrame({
-    "name":[],
-    "industry":[],
-    "sector":[],
-    "company page":[]
-    })
+    # get link to each company page 
+    annual_reports_df = pd.DataFrame({
+        "name":[],
+        "industry":[],
+        "sector":[],
+        "company page":[]
+        })
 
-annual_reports_df = get_index(main_link, sector_dirs, annual_reports_df)
+    annual_reports_df = crawl_index(main_link, sector_dirs, annual_reports_df, fake_headers, store_dir="data/scraping/pages/annual_reports")
         
             
-# making an empty column for the download links
-annual_reports_df["download links"] = pd.NA
+    # making an empty column for the download links
+    annual_reports_df["download links"] = pd.NA
+
 
+    # getting the download links
+    annual_reports_df = crawl_company_pages(annual_reports_df, main_link, 3, 4, headers=fake_headers, store_dir="data/scraping/pages/annual_reports")
 
-# getting the download links
-annual_reports_df = get_download_links(annual_reports_df, main_link, 3, 4)
 
+    # writing to csv
+    # annual_reports_df.to_csv("data/scraping/annual_report_links.csv", index=False)
 
-# writing to csv
-# annual_reports_df.to_csv("data/scraping/annual_report_links.csv", index=False)
 
+    # re-loading it here so I wouldn't have to repeat the process everytime
+    # annual_reports_df = pd.read_csv("../data/scraping/annual_report_links.csv")
 
-# re-loading it here so I wouldn't have to repeat the process everytime
-# annual_reports_df = pd.read_csv("../data/scraping/annual_report_links.csv")
+    # NOTE I merged the dfs to see what firms will have >=5 both sustainability and annual reports (deemed as minimum sufficient data)
+    # NOTE Then I use it to be able to download less of the data (because there's a lot of waste otherwise)
+    resp_reports_df = resp_reports_df[resp_reports_df["num_of_reports"] >=5]
 
-# NOTE I merged the dfs to see what firms will have >=5 both sustainability and annual reports (deemed as minimum sufficient data)
-# NOTE Then I use it to be able to download less of the data (because there's a lot of waste otherwise)
-resp_reports_df = resp_reports_df[resp_reports_df["num_of_reports"] >=5]
+    merged = resp_reports_df.merge(annual_reports_df, on=["name", "sector", "industry"])
 
-merged = resp_reports_df.merge(annual_reports_df, on=["name", "sector", "industry"])
+    merged.rename(columns={"company page_x":"company_page_resp", 
+                   "company page_y":"company_page_ann", 
+                   "download links_x":"download_links_resp",
+                   "download links_y":"download_links_ann", 
+                   "num_of_reports":"num_of_reports_resp",},
+                  inplace=True)
 
-merged.rename(columns={"company page_x":"company_page_resp", 
-               "company page_y":"company_page_ann", 
-               "download links_x":"download_links_resp",
-               "download links_y":"download_links_ann", 
-               "num_of_reports":"num_of_reports_resp",},
-              inplace=True)
 
+    # the annual report links go to the manifest too, only the merged companies get downloaded below
+    manifest_add_companies(manifest, annual_reports_df, "annual_reports", "data/scraping/annual_reports/", "download links")
 
-merged["num_of_reports_ann"] = [len(remove(eval(obs))) if '' in eval(obs) else len(eval(obs)) for obs in merged["download_links_ann"]]
+    merged["num_of_reports_ann"] = merged["company_page_ann"].map(report_counts(manifest, "annual_reports").set_index("company_page")["num_of_reports"])
 
-merged = merged[merged["num_of_reports_ann"] >=5]
+    merged = merged[merged["num_of_reports_ann"] >=5]
 
 
 
-# actual scraping
-# call the function
-scraping_loop(merged, "data/scraping/annual_reports/", "download_links_ann")
\ No newline at end of file
+    # actual scraping
+    # call the function
+    scraping_loop(merged, "data/scraping/annual_reports/", "download_links_ann", manifest, "annual_reports", "company_page_ann")
@@ -0,0 +1,67 @@
+# checks of the vectorized estimation in funcs.py against the statsmodels path it replaces
+# run with: python -m pytest test_funcs.py (from the code folder)
+
+import numpy as np
+import pandas as pd
+import statsmodels.api as sm
+import pytest
+
+import funcs
+
+MARKET_DICT = {"UNITED STATES":"S&P 500 COMPOSITE", "FRANCE":"MSCI EUROPE U$", "ISRAEL":"MSCI WORLD U$", "NOWHERE":"NA"}
+EXCHANGE_DICT = {"NYSE":"S&P 500 COMPOSITE", "London SE":"MSCI EUROPE U$", "Johannesburg SE":"MSCI WORLD U$"}
+
+
+@pytest.fixture(scope="module")
+def returns():
+    # a few firms on two markets, one skipped for its index (MSCI WORLD U$) and one picked through its exchange
+    rng = np.random.default_rng(0)
+    dates = pd.bdate_range("2019-01-01", "2019-06-28")
+    firms = [("A", "UNITED STATES", "NYSE"), ("B", "FRANCE", "London SE"), ("C", "UNITED STATES", "NYSE"),
+             ("D", "ISRAEL", "NYSE"), ("E", "NOWHERE", "London SE"), ("F", "FRANCE", "NYSE")]
+
+    df_ind = pd.DataFrame([(market, date) for market in ["MSCI EUROPE U$", "S&P 500 COMPOSITE"] for date in dates], columns=["NAME", "DATE"])
+    df_ind["INDEX_LOG_RETURN"] = rng.normal(0, 0.01, len(df_ind))
+
+    rows = []
+    for name, cntry, exchange in firms:
+        market = funcs.MarketFor(cntry, exchange, MARKET_DICT, EXCHANGE_DICT)
+        index = df_ind.loc[df_ind["NAME"] == market, "INDEX_LOG_RETURN"].to_numpy() if not pd.isna(market) else np.zeros(len(dates))
+        # heteroskedastic noise, so HC3 and the classical standard errors differ
+        noise = rng.normal(0, 0.01, len(dates)) * (1 + 50*np.abs(index))
+        rows.append(pd.DataFrame({"NAME":name, "CTRY_OF_DOM_NAME":cntry, "BOURSE_NAME":exchange, "DATE":dates,
+                                  "STOCK_LOG_RETURN":rng.normal(0, 0.001) + rng.uniform(0.5, 1.5)*index + noise}))
+    df_ret = pd.concat(rows, ignore_index=True)
+
+    # AbnormalReturns compares the dates with datetime.date
+    df_ret["DATE"] = df_ret["DATE"].dt.date
+    df_ind["DATE"] = df_ind["DATE"].dt.date
+
+    return df_ret, df_ind
+
+
+def test_abnormal_returns_fast_matches_statsmodels(returns):
+    df_ret, df_ind = returns
+    args = (MARKET_DICT, EXCHANGE_DICT, "2019-01-02", "2019-05-01", "STOCK_LOG_RETURN", "INDEX_LOG_RETURN")
+
+    slow = funcs.AbnormalReturns(df_ret.copy(), df_ind.copy(), *args)
+    fast, params = funcs.AbnormalReturnsFast(df_ret.copy(), df_ind.copy(), *args, return_params=True)
+
+    # the same rows, with the same normal returns and the same firms skipped
+    assert slow.index.equals(fast.index)
+    slow_normal = pd.to_numeric(slow["NORMAL_RETURN"])
+    assert slow_normal.notna().equals(fast["NORMAL_RETURN"].notna())
+    assert set(fast.loc[fast["NORMAL_RETURN"].isna(), "NAME"]) == {"D"}
+    np.testing.assert_allclose(fast["NORMAL_RETURN"], slow_normal, rtol=0, atol=1e-12)
+
+    # coefficients and HC3 standard errors of the firm regressions
+    est_start, est_end = pd.Timestamp("2019-01-02").date(), pd.Timestamp("2019-05-01").date()
+    assert sorted(params.index) == ["A", "B", "C", "E", "F"]
+    for name in params.index:
+        firm = df_ret.loc[(df_ret["NAME"] == name) & (df_ret["DATE"] > est_start) & (df_ret["DATE"] < est_end)]
+        index = df_ind.loc[(df_ind["NAME"] == params.loc[name, "MARKET"]) & (df_ind["DATE"] > est_start) & (df_ind["DATE"] < est_end)]
+        reg = sm.OLS(firm["STOCK_LOG_RETURN"].to_numpy(), sm.add_constant(index["INDEX_LOG_RETURN"].to_numpy())).fit(cov_type="HC3")
+
+        np.testing.assert_allclose(params.loc[name, ["const", "INDEX_LOG_RETURN"]].to_numpy(dtype=float), reg.params, rtol=1e-10, atol=1e-14)
+        np.testing.assert_allclose(params.loc[name, ["const_SE", "INDEX_LOG_RETURN_SE"]].to_numpy(dtype=float), reg.bse, rtol=1e-10, atol=1e-14)
+        assert params.loc[name, "N_OBS"] == len(firm)
@@ -0,0 +1,221 @@
+# checks of the crawler in scraping.py against a local stand-in for the report websites, serving the pages in fixtures/scraping
+# run with: python -m pytest test_scraping.py (from the code folder)
+# the stand-in can also be started by hand: python test_scraping.py 8765
+
+import os
+import sys
+import hashlib
+import threading
+import email.utils
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import pandas as pd
+import pytest
+
+import scraping
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures", "scraping")
+
+
+class FixtureHandler(BaseHTTPRequestHandler):
+    # /Companies?sect=<n> and /Company/<name> come from the fixture pages, /pdf/<name> from files_dir,
+    # with ETags (304 on If-None-Match) and Range requests (206) like the real sites
+    protocol_version = "HTTP/1.1"
+    files_dir = None
+
+    def log_message(self, *args):
+        pass
+
+    def send_bytes(self, status, data, headers=()):
+        self.send_response(status)
+        for key, value in headers:
+            self.send_header(key, value)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        if self.path.startswith("/Companies?sect="):
+            path = os.path.join(FIXTURES, "Companies", self.path.split("=")[-1] + ".html")
+        elif self.path.startswith("/Company/"):
+            path = os.path.join(FIXTURES, "Company", self.path.split("/")[-1] + ".html")
+        elif self.path.startswith("/pdf/") and self.files_dir is not None:
+            path = os.path.join(self.files_dir, self.path.split("/")[-1])
+        else:
+            path = None
+
+        if path is None or not os.path.exists(path):
+            self.send_bytes(404, b"")
+            return
+
+        with open(path, "rb") as file:
+            data = file.read()
+        etag = '"' + hashlib.md5(data).hexdigest() + '"'
+
+        if self.headers.get("If-None-Match") == etag:
+            self.send_bytes(304, b"", [("ETag", etag)])
+            return
+
+        if self.headers.get("Range"):
+            start = int(self.headers["Range"].split("=")[1].split("-")[0])
+            if start >= len(data):
+                self.send_bytes(416, b"", [("Content-Range", f"bytes */{len(data)}")])
+                return
+            self.send_bytes(206, data[start:], [("Content-Range", f"bytes {start}-{len(data)-1}/{len(data)}"), ("ETag", etag)])
+            return
+
+        self.send_bytes(200, data, [("ETag", etag), ("Last-Modified", email.utils.formatdate(os.path.getmtime(path), usegmt=True))])
+
+
+def serve(port=0, files_dir=None):
+    handler = type("Handler", (FixtureHandler,), {"files_dir":files_dir})
+    server = ThreadingHTTPServer(("127.0.0.1", port), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}"
+
+
+@pytest.fixture(scope="module")
+def site(tmp_path_factory):
+    files_dir = str(tmp_path_factory.mktemp("pdf"))
+    server, main_link = serve(files_dir=files_dir)
+    yield main_link, files_dir
+    server.shutdown()
+
+
+def empty_index():
+    return pd.DataFrame({"name":[], "industry":[], "sector":[], "company page":[]})
+
+
+def company_columns(df):
+    df["download links"] = pd.NA
+    df["characteristics_dirty"] = pd.NA
+    df["year_lists"] = pd.NA
+    return df
+
+
+def test_crawler_matches_sequential_functions(site):
+    main_link, _ = site
+
+    sequential = company_columns(scraping.get_index(main_link, "/Companies?sect=", empty_index()))
+    sequential = scraping.get_download_links(sequential, main_link, 3, 4)
+    sequential = scraping.get_company_charachteristics(sequential, main_link, 3, 5, 6)
+
+    crawled = company_columns(scraping.crawl_index(main_link, "/Companies?sect=", empty_index()))
+    crawled = scraping.crawl_company_pages(crawled, main_link, 3, 4, 5, 6)
+
+    assert len(crawled) == 18
+    assert crawled.drop(columns="characteristics_dirty").equals(sequential.drop(columns="characteristics_dirty"))
+    # the characteristics end up in the csv as html
+    assert crawled["characteristics_dirty"].astype(str).tolist() == sequential["characteristics_dirty"].astype(str).tolist()
+
+
+def test_page_store_revalidates_pages(site, tmp_path, capsys):
+    main_link, _ = site
+    store_dir = str(tmp_path / "pages")
+    index = company_columns(scraping.crawl_index(main_link, "/Companies?sect=", empty_index()))
+
+    def crawl(**kwargs):
+        crawled = scraping.crawl_company_pages(index.copy(), main_link, 3, 4, 5, 6, store_dir=store_dir, **kwargs)
+        # fetch_pages prints how every page was got, the parsing can print after it
+        return crawled.astype(str), [line for line in capsys.readouterr().out.splitlines() if line.startswith("18 pages:")]
+
+    first, counts = crawl()
+    assert counts == ["18 pages: 0 cache hits, 0 not modified, 18 downloaded, 0 failed"]
+
+    # the stand-in answers the stored ETags with 304, the pages come from the store
+    second, counts = crawl()
+    assert counts == ["18 pages: 0 cache hits, 18 not modified, 0 downloaded, 0 failed"]
+    assert second.equals(first)
+
+    # pages checked less than max_age seconds ago are not requested at all
+    third, counts = crawl(max_age=3600)
+    assert counts == ["18 pages: 18 cache hits, 0 not modified, 0 downloaded, 0 failed"]
+    assert third.equals(first)
+
+
+@pytest.mark.parametrize("parser", sorted({"html.parser", scraping.FAST_PARSER}))
+def test_single_parse_matches_old_parsers(site, parser):
+    main_link, _ = site
+    company_dir = os.path.join(FIXTURES, "Company")
+    pages = []
+    for filename in sorted(os.listdir(company_dir)):
+        with open(os.path.join(company_dir, filename), "rb") as file:
+            pages.append(file.read())
+
+    # prints the parse time per page of the old and the new extraction (python -m pytest -s to see it)
+    result = scraping.compare_parsers(pages, main_link, parser)
+
+    assert len(result) == len(pages)
+    assert result[["same_links", "same_characteristics", "same_years"]].all().all()
+
+
+def test_manifest_resumes_only_missing_files(site, tmp_path, monkeypatch):
+    main_link, files_dir = site
+    # failed downloads are logged to exceptions.log in the working directory
+    monkeypatch.chdir(tmp_path)
+    for i in range(4):
+        with open(os.path.join(files_dir, f"report_{i}.pdf"), "wb") as file:
+            file.write(os.urandom(50000 * (i + 1)))
+
+    df = pd.DataFrame({"name":["Acme Co", "Foo? Inc"], "industry":["a", "b"], "sector":["s", "s"], "company page":["p1", "p2"],
+                       "download links":[str(["", f"{main_link}/pdf/report_0.pdf", f"{main_link}/pdf/report_1.pdf"]),
+                                         [f"{main_link}/pdf/report_2.pdf", f"{main_link}/pdf/missing.pdf"]]})
+    manifest = scraping.open_manifest(str(tmp_path / "manifest.sqlite"))
+    folder = str(tmp_path) + "/"
+
+    scraping.scraping_loop(df, folder, "download links", manifest, "resp")
+    statuses = dict(manifest.execute("SELECT url, status FROM links"))
+    assert statuses[f"{main_link}/pdf/report_0.pdf"] == 200
+    assert statuses[f"{main_link}/pdf/missing.pdf"] == 404
+
+    # a deleted file and the failed one are the only ones tried again
+    os.remove(folder + "acme_co/report_0.pdf")
+    results = scraping.scraping_loop(df, folder, "download links", manifest, "resp")
+    assert sorted(results["link"]) == [f"{main_link}/pdf/missing.pdf", f"{main_link}/pdf/report_0.pdf"]
+
+    # a company page that could not be fetched keeps its links
+    df.loc[0, "download links"] = pd.NA
+    scraping.manifest_add_companies(manifest, df, "resp", folder, "download links")
+    counts = scraping.report_counts(manifest, "resp").set_index("company_page")
+    assert counts["num_of_reports"].to_dict() == {"p1":2, "p2":2}
+    assert counts.loc["p1", "num_downloaded"] == 2
+
+
+def test_stream_download_checks_existing_files(site, tmp_path, monkeypatch):
+    main_link, files_dir = site
+    monkeypatch.chdir(tmp_path)
+    data = os.urandom(300000)
+    with open(os.path.join(files_dir, "big.pdf"), "wb") as file:
+        file.write(data)
+    link = f"{main_link}/pdf/big.pdf"
+    session = scraping.requests.Session()
+
+    # a file cut short (as the old scraper could leave it) is resumed with a Range request
+    with open(tmp_path / "big.pdf", "wb") as file:
+        file.write(data[:120000])
+    result = scraping.stream_download(link, str(tmp_path), session)
+    assert result["status"] == 206
+    assert (tmp_path / "big.pdf").read_bytes() == data
+
+    # a complete file without known size or hash is confirmed by the server (416 at its end)
+    result = scraping.stream_download(link, str(tmp_path), session)
+    assert result["status"] == "exists" and result["sha256"] == hashlib.sha256(data).hexdigest()
+
+    # with a known hash the file is checked without a request, a mismatch is downloaded again and checked
+    assert scraping.stream_download(link, str(tmp_path), session, expected_sha256=result["sha256"])["status"] == "exists"
+    result = scraping.stream_download(link, str(tmp_path), session, expected_sha256="0"*64, expected_size=len(data))
+    assert result["error"] is not None
+    assert not os.path.exists(tmp_path / "big.pdf") and not os.path.exists(tmp_path / "big.pdf.part")
+
+    # a file from the old scraper whose link has gone dead is left where it is
+    with open(tmp_path / "old.pdf", "wb") as file:
+        file.write(data[:1000])
+    result = scraping.stream_download(f"{main_link}/pdf/old.pdf", str(tmp_path), session)
+    assert result["status"] == 404
+    assert (tmp_path / "old.pdf").read_bytes() == data[:1000] and not os.path.exists(tmp_path / "old.pdf.part")
+
+
+if __name__ == "__main__":
+    server, main_link = serve(int(sys.argv[1]) if len(sys.argv) > 1 else 8765)
+    print(f"serving {FIXTURES} on {main_link}")
+    threading.Event().wait()